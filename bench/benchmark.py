@@ -0,0 +1,181 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+
+# Gruid Translator by Bruno Benkel
+# To the extent possible under law, the person who associated CC0 with Gruid Translator has waived
+# all copyright and related or neighboring rights to Gruid Translator.
+
+"""
+Benchmarks each stage of the translator over synthetic GEMC files of different sizes: parsing,
+hit extraction, time series generation (with and without depth and the detecting plane), and each
+OUTTYPE's writer. Results are stored as .json so that they can be compared between versions.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import constants as c
+import file_io as io
+import gemcevent_handler as gemc_eh
+import gemcfile_handler as fh
+import gruidevent_handler as gruid_eh
+
+import gemc_generator as gen
+
+# Default scales, as (nevents, nhits per event).
+SCALES = "20x500,20x5000,5x50000"
+
+# Binning configurations for generate_event(), as (dt, dx, dy, dz, plane).
+NAN   = float("nan")
+PLANE = (0., 0., 0., 0., .3, 1.)
+CONFS = {
+    "generate_event":               (1., .3, .3, NAN, (NAN,)*6),
+    "generate_event (dz)":          (1., .3, .3, .5,  (NAN,)*6),
+    "generate_event (dz + plane)":  (1., .3, .3, .5,  PLANE),
+}
+
+def _time(func, repeat):
+    """Call func repeat times, returning the fastest time in seconds and the last result.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        t0  = time.perf_counter()
+        res = func()
+        best = min(best, time.perf_counter() - t0)
+    return (best, res)
+
+def _parse(addr, typed):
+    """Parse every event in a GEMC file.
+    """
+    with open(addr) as f:
+        fh.store_metadata(f)
+        return list(fh.iter_events(f, typed))
+
+def _generate(ged, nrows, ncols, conf, engine):
+    """Generate the gruid events for every non-empty event in ged.
+    """
+    (dt, dx, dy, dz, plane) = conf
+    grd = {}
+    for (key, hits) in ged.items():
+        grd[key] = gruid_eh.generate_event(hits, nrows, ncols, dt, dx, dy, dz, *plane, engine)
+    return grd
+
+def _generate_arrays(ged, nrows, ncols, conf):
+    """Generate the columnar gruid events written by the .npz OUTTYPEs for every event in ged.
+    """
+    (dt, dx, dy, dz, plane) = conf
+    return {key: gruid_eh.generate_arrays(hits, nrows, ncols, dt, dx, dy, dz, *plane)
+            for (key, hits) in ged.items()}
+
+def bench_scale(tmpdir, nevents, nhits, nrows, ncols, repeat, engines):
+    """
+    Benchmark every stage for one scale.
+    :return: a list of result dictionaries, one per stage.
+    """
+    addr = os.path.join(tmpdir, gen.gen_filename(nrows, ncols))
+    gen.write_gemc(addr, nevents, nhits, nrows, ncols)
+    scale   = str(nevents) + "x" + str(nhits)
+    size    = os.path.getsize(addr)/1e6
+    results = []
+    def add(stage, seconds):
+        results.append({"scale": scale, "stage": stage, "seconds": seconds, "events": nevents,
+                        "hits": nevents*nhits, "size (MB)": size,
+                        "events/s": nevents/seconds if seconds else None,
+                        "hits/s": nevents*nhits/seconds if seconds else None})
+        print("{:>10} {:<40} {:10.4f} s".format(scale, stage, seconds), file=sys.stderr)
+
+    # Parsing and hit extraction.
+    for typed in (False, True):
+        suffix = " (typed)" if typed else ""
+        (t, events) = _time(lambda: _parse(addr, typed), repeat)
+        add("store_event" + suffix, t)
+        (t, ged) = _time(lambda: [gemc_eh.extract_hits(event) for event in events], repeat)
+        add("extract_hits" + suffix, t)
+    ged = {"event " + str(ei): hits for (ei, hits) in enumerate(ged) if hits.translatable()}
+
+    # Time series generation.
+    for engine in engines:
+        suffix = "" if engine == c.ENGINE_VEC else " [" + engine + "]"
+        for (stage, conf) in CONFS.items():
+            (t, grd) = _time(lambda: _generate(ged, nrows, ncols, conf, engine), repeat)
+            add(stage + suffix, t)
+
+    # Writers, using the most complete gruid events.
+    metadata = io.load_metadata(addr)
+    cols     = _generate_arrays(ged, nrows, ncols, conf)
+    for outtype in range(1, c.MAXTYPE+1):
+        def write():
+            out = cols if c.NPZTYPE <= outtype < c.NDJTYPE else grd
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                io.generate_output(out, ged, metadata, os.path.basename(addr), 1, nevents, outtype)
+        (t, _) = _time(write, repeat)
+        add("OUTTYPE " + str(outtype), t)
+    return results
+
+def _version():
+    """Get the current git revision, if available.
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except OSError:
+        return None
+
+def compare(old, new):
+    """Print the speedup of each stage in new with respect to old.
+    """
+    oldres = {(r["scale"], r["stage"]): r["seconds"] for r in old["results"]}
+    print("{:>10} {:<40} {:>10} {:>10} {:>8}".format("scale", "stage", "old", "new", "speedup"))
+    for r in new["results"]:
+        o = oldres.get((r["scale"], r["stage"]))
+        if o is None: continue
+        print("{:>10} {:<40} {:10.4f} {:10.4f} {:7.2f}x".format(r["scale"], r["stage"], o,
+              r["seconds"], o/r["seconds"] if r["seconds"] else float("inf")))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the translator's stages.")
+    parser.add_argument("-s", "--scales",  help="comma-separated scales to benchmark, each as "
+                        "NEVENTSxNHITS. Default is " + SCALES + ".", default=SCALES)
+    parser.add_argument("-r", "--nrows",   help="number of rows. Default is 20.", type=int,
+                        default=20)
+    parser.add_argument("-c", "--ncols",   help="number of columns. Default is 30.", type=int,
+                        default=30)
+    parser.add_argument("-n", "--repeat",  help="number of times each stage is run, keeping the "
+                        "fastest. Default is 3.", type=int, default=3)
+    parser.add_argument("--reference",     help="also benchmark the reference engine. Very slow "
+                        "for large scales.", action="store_true")
+    parser.add_argument("-o", "--output",  help="file where results are stored as .json.")
+    parser.add_argument("--compare",       help="results file from a previous run to compare "
+                        "against.")
+    args = parser.parse_args()
+
+    engines = [c.ENGINE_VEC, c.ENGINE_REF] if args.reference else [c.ENGINE_VEC]
+    report  = {"version": _version(), "python": platform.python_version(),
+               "machine": platform.machine(), "nrows": args.nrows, "ncols": args.ncols,
+               "repeat": args.repeat, "results": []}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        io.get_path = lambda: tmpdir + "/out/" # Keep writers' output away from out/.
+        for scale in args.scales.split(','):
+            (nevents, nhits) = (int(x) for x in scale.split('x'))
+            report["results"] += bench_scale(tmpdir, nevents, nhits, args.nrows, args.ncols,
+                                             args.repeat, engines)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
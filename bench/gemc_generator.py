@@ -0,0 +1,158 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+
+# Gruid Translator by Bruno Benkel
+# To the extent possible under law, the person who associated CC0 with Gruid Translator has waived
+# all copyright and related or neighboring rights to Gruid Translator.
+
+"""
+Generates synthetic GEMC files in the format exported by bcal_generator, to benchmark the translator
+without needing real simulations. Hits are random, but follow the structure the translator expects:
+massive particle tracks crossing the detector's body, photon hits on the four sensor endplates, and
+some uninteresting hits that should be ignored.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import constants as c
+
+# Columns written to the raw and digitized banks, in order.
+IRCOLS = [c.S_PID, c.S_TID, c.S_AVGX, c.S_AVGY, c.S_AVGZ, c.S_AVGT, c.S_EDEP, c.S_TRACKE, "procID"]
+IDCOLS = [c.S_HITN, c.S_VOL]
+
+# Default fraction of massive particle, photon and uninteresting hits.
+PIDMIX = (0.3, 0.65, 0.05)
+
+def gen_filename(nrows, ncols, tag="bench"):
+    """Generate a filename from which decode_filename() can obtain nrows and ncols.
+    """
+    return "gemc_" + str(nrows) + "_" + str(ncols) + "_" + tag + ".txt"
+
+def _gen_hits(rnd, nhits, nrows, ncols, tspread, pidmix):
+    """
+    Generate the columns of the raw and digitized banks for one event.
+    :return: a dictionary of lists of strings, with one key per column in IRCOLS and IDCOLS.
+    """
+    # Detector's half-sizes, in mm.
+    hx = 10.*c.DX(ncols)
+    hy = 10.*c.DY(nrows)
+    hz = 10.*c.DZ
+
+    cols   = {col: [] for col in IRCOLS + IDCOLS}
+    ntrk   = max(1, nhits//20)
+    tracks = [(rnd.uniform(-hx, hx), rnd.uniform(-hy, hy), rnd.uniform(-.2, .2),
+               rnd.uniform(-.2, .2)) for _ in range(ntrk)]
+    for hi in range(nhits):
+        r = rnd.random()
+        if r < pidmix[0]: # Massive particle hit along a track.
+            tid = rnd.randrange(ntrk)
+            pid = rnd.choice([c.S_MMPID, c.S_MPPID, c.S_EMPID, c.S_EPPID, c.S_NPID])
+            vol = rnd.choice([1, 2, 3])
+            z   = rnd.uniform(-hz+.01, hz-.01)
+            (x0, y0, ax, ay) = tracks[tid]
+            x   = max(-hx+1e-3, min(hx-1e-3, x0 + ax*z))
+            y   = max(-hy+1e-3, min(hy-1e-3, y0 + ay*z))
+            t   = (z+hz)/300. + rnd.uniform(0, .05*tspread)
+            tid += 1
+        elif r < pidmix[0] + pidmix[1]: # Photon hit on an endplate.
+            pid = c.S_PHOTONPID
+            vol = rnd.choice([c.SENSOR1A_ID, c.SENSOR2A_ID, c.SENSOR1B_ID, c.SENSOR2B_ID])
+            x   = rnd.uniform(-hx+1e-3, hx-1e-3)
+            y   = rnd.uniform(-hy+1e-3, hy-1e-3)
+            z   = -hz if vol in (c.SENSOR1A_ID, c.SENSOR1B_ID) else hz
+            t   = rnd.uniform(0, tspread)
+            tid = ntrk + 1 + hi
+        else: # Uninteresting hit.
+            pid = rnd.choice(["22", c.S_PHOTONPID])
+            vol = rnd.choice([1, 2])
+            x   = rnd.uniform(-hx, hx)
+            y   = rnd.uniform(-hy, hy)
+            z   = rnd.uniform(-hz, hz)
+            t   = rnd.uniform(0, tspread)
+            tid = ntrk + 1 + hi
+
+        cols[c.S_HITN]  .append(str(hi+1))
+        cols[c.S_VOL]   .append(str(vol*10**8 + rnd.randrange(10**6)))
+        cols[c.S_PID]   .append(pid)
+        cols[c.S_TID]   .append(str(tid))
+        cols[c.S_AVGX]  .append("%.6g" % x)
+        cols[c.S_AVGY]  .append("%.6g" % y)
+        cols[c.S_AVGZ]  .append("%.6g" % z)
+        cols[c.S_AVGT]  .append("%.6g" % t)
+        cols[c.S_EDEP]  .append("0" if rnd.random() < .05 else "%.5g" % rnd.uniform(1e-6, 2.))
+        cols[c.S_TRACKE].append("%.5g" % rnd.uniform(0, 1000))
+        cols["procID"]  .append("0")
+    return cols
+
+def write_gemc(addr, nevents, nhits, nrows, ncols, tspread=20., pidmix=PIDMIX, seed=1):
+    """
+    Write a synthetic GEMC file.
+    :param addr:    address of the file to be written.
+    :param nevents: number of events in the file.
+    :param nhits:   number of hits per event.
+    :param nrows:   number of rows in the simulated detector.
+    :param ncols:   number of columns in the simulated detector.
+    :param tspread: time spread of the photon hits in ns.
+    :param pidmix:  3-tuple with the fraction of massive particle (0), photon (1) and uninteresting
+                    (2) hits. Fractions are normalized to add up to 1.
+    :param seed:    seed for the random number generator, so that files can be reproduced.
+    """
+    rnd    = random.Random(seed)
+    pidmix = [f/sum(pidmix) for f in pidmix]
+    with open(addr, 'w') as f:
+        f.write(" ##########################################\n")
+        f.write(" Synthetic GEMC file for benchmarking.\n")
+        for (key, value) in (("RUNNO", "1"), ("N", str(nevents)), ("BEAM_P", "mu-,1*GeV")):
+            f.write("   > Option " + key + " " + value + "\n")
+
+        for ei in range(nevents):
+            cols = _gen_hits(rnd, nhits, nrows, ncols, tspread, pidmix)
+            f.write(c.S_HBANK + "\n")
+            f.write("   (10, 0) evn:\t" + str(ei+1) + "\n")
+            f.write(c.S_UHBANK + "\n")
+            f.write(c.S_GPBANK + "\n")
+            f.write("   | " + c.S_PARTICLE + " 1 pid: 13 momentum p: 1000 MeV vertex vz: 0\n")
+            f.write("   | " + c.S_HIT + " count n: " + str(nhits) + " , deposited E 0 , total P 0"
+                    "\n")
+            f.write(c.S_IRBANK + "\n")
+            for col in IRCOLS: f.write("   (51, 0) " + col + ":\t" + "\t".join(cols[col]) + "\n")
+            f.write(c.S_IDBANK + "\n")
+            for col in IDCOLS: f.write("   (52, 0) " + col + ":\t" + "\t".join(cols[col]) + "\n")
+            f.write(c.S_EOE + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic GEMC file.")
+    parser.add_argument("outdir",          help="directory where the file is written.")
+    parser.add_argument("nevents",         help="number of events.", type=int)
+    parser.add_argument("nhits",           help="number of hits per event.", type=int)
+    parser.add_argument("-r", "--nrows",   help="number of rows. Default is 20.", type=int,
+                        default=20)
+    parser.add_argument("-c", "--ncols",   help="number of columns. Default is 30.", type=int,
+                        default=30)
+    parser.add_argument("-t", "--tspread", help="time spread of photon hits in ns. Default is 20.",
+                        type=float, default=20.)
+    parser.add_argument("-p", "--pidmix",  help="comma-separated fractions of massive particle, "
+                        "photon and uninteresting hits. Default is 0.3,0.65,0.05.",
+                        default=','.join(str(f) for f in PIDMIX))
+    parser.add_argument("-s", "--seed",    help="random seed. Default is 1.", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.nevents < 1 or args.nhits < 1:
+        print("ERROR: NEVENTS and NHITS should be at least 1. Exiting...", file=sys.stderr)
+        exit()
+    pidmix = tuple(float(f) for f in args.pidmix.split(','))
+    if len(pidmix) != 3 or min(pidmix) < 0 or sum(pidmix) == 0:
+        print("ERROR: PIDMIX should be three non-negative fractions. Exiting...", file=sys.stderr)
+        exit()
+
+    addr = os.path.join(args.outdir, gen_filename(args.nrows, args.ncols))
+    write_gemc(addr, args.nevents, args.nhits, args.nrows, args.ncols, args.tspread, pidmix,
+               args.seed)
+    print(addr)
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,9 @@ GEMC, with some additional stuff to help standardize the program.
 """
 
 # Usage strings.
-IHELP   = "path of the gemc file to be processed."
+IHELP   = "path of the gemc file to be processed. Can also be a directory or a quoted glob "\
+          "pattern, to process every .txt file in it or matching it as a batch. Files compressed "\
+          "with gzip, bz2 or xz are decompressed while they're read."
 THELP   = "length of each time step for the generated time series in ns."
 XHELP   = "length of each row for each of the time series' matrices in cm."
 YHELP   = "length of each column for each of the time series' matrices in cm."
@@ -24,15 +26,155 @@ FHELP   = "event number of the first event in the gemc file that should be read.
           "events are counted from 1 onward. Default is 1."
 NHELP   = "number of events to read, counting from the file set with FEVENT. Set to 0 to read "\
           "until the end of file. Default is 0."
-OHELP   = "type of output to be generated. Can be any integer from 1 to 5. Check the README for a "\
-          "detailed description of each alternative. Default is 2."
+OHELP   = "type of output to be generated. Can be any integer from 1 to 13. Check the README for "\
+          "a detailed description of each alternative. Default is 2."
 RHELP   = "number of rows set in the gemc simulation. By default this is read from the "\
           "filename, but this argument can be set to override this behaviour."
 CHELP   = "number of columns set in the gemc simulation. By default this is read from the "\
           "filename, but this argument can be set to override this behaviour."
+EHELP   = "engine used to generate the time series and detecting plane. Can be either "\
+          "\"vector\", which processes all hits at once with array arithmetic, or \"reference\", "\
+          "which loops through each hit, bin and track segment. Both produce the same output. "\
+          "Not used by the .npz outputs, which have their own. Default is \"vector\"."
+SHELP   = "stream events, translating and writing each one as soon as it's read instead of "\
+          "keeping the entire file in memory. Events are written in the order they are read."
+WHELP   = "number of processes used to translate events in parallel. Output is the same as with "\
+          "a single process. Default is 1."
+IDXHELP = "use an index of the byte offsets where each event starts, stored next to the gemc "\
+          "file and built on the first run. Allows FEVENT to be reached without parsing every "\
+          "event before it, and lets each of the WORKERS read its own events."
+TYHELP  = "parse the columns of the raw and digitized banks used by the program directly into "\
+          "typed arrays, instead of storing every column as strings and converting each hit later."
+MMHELP  = "memory-map the gemc file and find each event's banks with byte searches instead of "\
+          "reading it line by line. Combined with --typed, only the columns used by the program "\
+          "are decoded."
+PHELP   = "read, translate and write events in three threads running at the same time, joined by "\
+          "queues of at most 16 events, so that the disk and the CPU don't wait for each other. "\
+          "Translation is still split between the WORKERS if given. Implies --stream."
+STATHELP = "print how long each stage of the program took and how many events, hits and cells "\
+           "were processed to stderr. If a file is given, the report is stored there as .json "\
+           "instead."
+PROFHELP = "comma-separated list of functions to profile with cProfile, in a \"module.function\" "\
+           "format (e.g. \"gruidevent_handler._gen_ts\"). The profile is printed with the report "\
+           "of --stats. Functions called inside WORKERS are not profiled. Can't be used with "\
+           "--pipeline on Python 3.12+, where only one thread can be profiled at a time."
+CACHEHELP = "cache the hits and time series of each event, so that later runs with the same gemc "\
+            "file and parameters only need to write them. Runs that change only some of the "\
+            "parameters reuse the time series that didn't change. The cache is stored in CACHE if "\
+            "given, or in cache/ otherwise. Implies --index."
+CSIZEHELP = "maximum size of the cache in MB. The least recently used entries are removed once "\
+            "it's exceeded. Default is 1024."
+SWHELP    = "binning configurations to translate the gemc file with, reading and extracting its "\
+            "hits only once. Given as a semicolon-separated grid like \"dt=0.5,1;dz=0.25,0.5\", "\
+            "which is expanded to every combination of dt, dx, dy and dz, with missing parameters "\
+            "taken from the arguments. Can be repeated to add more configurations. Each "\
+            "configuration is written to its own output, with its parameters added to the filename."
+OIDXHELP  = "store an index next to each .json output with where each event, each of its sections "\
+            "and each of their time steps are stored, so that they can be loaded one at a time "\
+            "with file_io.OutputReader without decoding the whole file."
+CMPHELP   = "compress the .json outputs and NDJSON shards with the given format while they're "\
+            "written, adding its extension to their filenames. Doesn't apply to .npz outputs, "\
+            "which are already compressed."
+PREFHELP  = "skip events without massive particle hits or photon hits on the endplates, which "\
+            "can't be translated, by reading only their pid, totEdep and id columns instead of "\
+            "parsing the entire event. Implied by PIDS, VOLUMES, MINHITS and MINEDEP."
+PIDSHELP  = "comma-separated list of PIDs. Only events with at least one hit of one of these "\
+            "particles are translated."
+VOLSHELP  = "comma-separated list of volume IDs, as the first digits of the id column (e.g. 4 for "\
+            "the side 1 endplate). Only events with at least one hit in one of these volumes are "\
+            "translated."
+MINHHELP  = "minimum number of hits of the events that are translated."
+MINEHELP  = "minimum energy deposited by all the hits of the events that are translated, in MeV."
+CKPTHELP  = "store a checkpoint next to the outputs every CHECKPOINT events written, with the "\
+            "last event written, where the gemc file continues after it, and the state of the "\
+            "outputs. A run with the same arguments resumes from the checkpoint, appending to the "\
+            "outputs instead of starting over. Implies --stream. Default is 100."
+AGGHELP   = "store each cell of the detector's body time series as the number of hits and energy "\
+            "deposited by each PID in it, instead of listing the PID and energy deposited of "\
+            "every hit. Has no effect if DZ isn't given."
+MMEMHELP  = "maximum size in MB of the translated events kept in memory until the outputs are "\
+            "written. Past it, they're spilled to temporary segments next to the outputs, which "\
+            "are merged into each output once every event is translated. Reads events one at a "\
+            "time, as --stream does. Can't be used with .npz outputs."
+SPLITHELP = "split events with at least SPLITHITS hits between the WORKERS, generating their "\
+            "time series and detecting plane at the same time and splitting time series with that "\
+            "many hits in ranges of time steps. Hits are shared with the WORKERS through shared "\
+            "memory. Events are then translated one at a time. Only used by the vector engine, "\
+            "and requires at least 2 WORKERS. Default is 100000."
+SEVHELP   = "maximum number of events in each shard of the NDJSON outputs. Set to 0 for no limit. "\
+            "Default is 1000."
+SSIZEHELP = "maximum size of each shard of the NDJSON outputs in MB, before compression. Set to 0 "\
+            "for no limit. Default is 256."
+ADDRHELP  = "port on localhost to serve translation requests on over HTTP, or path of a Unix "\
+            "socket to serve them on instead."
+REQHELP   = "send a translation request to the service running on ADDRESS and print its reply, "\
+            "instead of starting a service. Given as a query string like "\
+            "\"filename=bcal_20_30_x.txt&dt=1&dx=0.3&dy=0.3&fevent=5&nevents=1\", with the same "\
+            "parameters as main.py."
+KEEPHELP  = "maximum number of translated events kept in memory between requests. Default is 256."
+
+# Binning engines.
+ENGINE_VEC = "vector"
+ENGINE_REF = "reference"
 
 # Paths, prefixes, etc.
-OUTPREF = "out_"
+OUTPREF   = "out_"
+INDEXSUFF = ".idx"
+CACHESUFF = ".pkl"
+CKPTSUFF  = ".ckpt"
+SPILLSUFF = ".spill"
+GEMCEXT   = ".txt"
+MANIFEST  = "manifest.json"
+SHARDPREF = "part-"
+NDJEXT    = ".ndjson"
+
+# Compression formats supported for input and output files, with the bytes every file in the format
+# starts with and the extension added to its name.
+GZIP = "gzip"
+BZ2  = "bz2"
+XZ   = "xz"
+COMPRESSIONS = {
+    GZIP : (b"\x1f\x8b",     ".gz"),
+    BZ2  : (b"BZh",          ".bz2"),
+    XZ   : (b"\xfd7zXZ\x00", ".xz"),
+}
+# Compression level used for gzip outputs, which trades a slightly larger file for much faster
+# writes than gzip's default.
+GZIPLEVEL = 6
+
+# Default maximum size of the translation cache, in MB, and version of the objects stored in it.
+# The version is part of every entry's key, and should be changed whenever their format changes so
+# that old entries are never loaded.
+CACHESIZE    = 1024
+CACHEVERSION = 2
+
+# Output types. Types from NPZTYPE and from NDJTYPE store the same data as types 2 to 5, but in .npz
+# format and as sharded NDJSON respectively.
+NPZTYPE = 6
+NDJTYPE = 10
+MAXTYPE = 13
+
+# Default minimum number of hits of the events split between the WORKERS.
+SPLITHITS = 100000
+
+# Default limits of each NDJSON shard, in events and MB.
+SHARDEVENTS = 1000
+SHARDSIZE   = 256
+
+# Default number of events written between checkpoints.
+CKPTEVENTS = 100
+
+# Number of events read at once by each worker when reading from an indexed file.
+RANGESIZE = 8
+
+# Number of events waiting between each stage of the pipeline.
+QUEUESIZE = 16
+
+# Default number of translated events kept in memory by the translation service, and host and path
+# on which it serves requests over HTTP.
+SERVEEVENTS = 256
+SERVEHOST   = "127.0.0.1"
+SERVEPATH   = "/translate"
 
 # Generic strings used to identify banks by name in python code.
 HBANK  = "header bank"
@@ -68,6 +210,16 @@ S_EMPID     =   "11"
 S_EPPID     =  "-11"
 S_NPID      = "2112"
 
+# Columns of the raw and digitized banks used by the program, with the type used to store them when
+# the banks are parsed directly into numpy arrays.
+TYPEDCOLS = {S_HITN: "int64", S_VOL: "int64", S_TID: "int64", S_PID: "int64", S_AVGX: "float64",
+             S_AVGY: "float64", S_AVGZ: "float64", S_AVGT: "float64", S_EDEP: "float64",
+             S_TRACKE: "float64"}
+
+# PIDs as integers, for use with typed banks.
+PHOTONPID = int(S_PHOTONPID)
+MASSPIDS  = [int(S_MMPID), int(S_MPPID), int(S_EMPID), int(S_EPPID), int(S_NPID)]
+
 # Strings defined and used by this program.
 S_EVENT       = "event"
 S_GEMCMETA    = "gemc metadata"
@@ -104,6 +256,67 @@ S_DT    = "dt"
 S_DX    = "dx"
 S_DY    = "dy"
 S_DZ    = "dz"
+S_TSTEP = "time step"
+S_AGGREGATED = "aggregated"
+S_IDXSIZE    = "size"
+S_IDXMTIME   = "mtime"
+S_IDXMETAEND = "metadata end"
+S_IDXEVENTS  = "events"
+S_IDXSPAN    = "span"
+S_IDXSECTS   = "sections"
+S_IDXSTEPS   = "time steps"
+S_ERROR      = "error"
+S_COLUMNAR   = "columnar"
+
+# Keys of the checkpoints of a run and of the state of each output stored in them.
+S_CKARGS     = "arguments"
+S_CKEVENT    = "last event"
+S_CKOFFSET   = "offset"
+S_CKOUTPUTS  = "outputs"
+S_CKSIZE     = "size"
+S_CKENTRIES  = "entries"
+S_CKPOS      = "position"
+S_CKINDEX    = "index"
+
+# Names of the timers and counters kept by stats, and of the keys in its report.
+ST_READ      = "read"
+ST_EXTRACT   = "extract hits"
+ST_GENERATE  = "generate - "
+ST_WRITE     = "write"
+ST_EVENTS    = "events read"
+ST_SKIPPED   = "events skipped (empty)"
+ST_FILTERED  = "events skipped (filtered)"
+ST_HITS      = "hits - "
+ST_CELLS     = "cells - "
+ST_BYTES     = "bytes written"
+ST_CACHEHIT  = "cache hits"
+ST_CACHEMISS = "cache misses"
+ST_SPILLED   = "segments spilled"
+ST_SPLIT     = "generate - split events"
+ST_NSPLIT    = "events split"
+S_WALL       = "wall time (s)"
+S_TIMERS     = "timers (s)"
+S_COUNTERS   = "counters"
+S_EVENTSPS   = "events/s"
+S_HITSPS     = "hits/s"
+
+# Keys of the manifest written for batches of files.
+S_MFILES    = "files"
+S_MINPUT    = "input"
+S_MNROWS    = "nrows"
+S_MNCOLS    = "ncols"
+S_MOUTPUTS  = "outputs"
+S_MREAD     = "events read"
+S_MWRITTEN  = "events written"
+S_MTIME     = "time (s)"
+
+# Keys of the manifest written with each sharded NDJSON output.
+S_MSHARDS   = "shards"
+S_MFILE     = "file"
+S_MEVENTS   = "events"
+S_MBYTES    = "bytes"
+S_MFIRST    = "first event"
+S_MLAST     = "last event"
 
 # IDs of the sensor endplates, as defined by the gemc simulation.
 SENSOR1A_ID =  4
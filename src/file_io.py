@@ -9,12 +9,24 @@ only file allowed to handle IO.
 """
 
 from pathlib import Path
+import bz2
+import glob
+import gzip
+import hashlib
+import heapq
 import json
+import lzma
+import mmap
+import pickle
 import re
 import os
+import sys
+import tempfile
+import numpy
 
 import constants as c
 import gemcfile_handler as fh
+import stats
 
 def split_address(addr):
     """Split an address into path and filename.
@@ -32,83 +44,1041 @@ def get_path():
     """
     return (os.path.abspath(os.path.dirname(__file__)) + "/../out/")
 
-def generate_outfilename(addr, f, n):
+def get_cache_path():
+    """Get the path to the default cache directory.
+    """
+    return (os.path.abspath(os.path.dirname(__file__)) + "/../cache/")
+
+def generate_outfilename(addr, f, n, ext=".json", suffix=""):
     """generate the output filename.
     """
     return '_'.join('.'.join(addr.split('.')[0:-1]).split('_')[0:-1]) \
-                + "_" + str(f) + "-" + str(f+n-1) + ".json"
+                + "_" + str(f) + "-" + str(f+n-1) + suffix + ext
 
-def store_dict(dict, addr):
-    """Store a dictionary as a json file to the given addr.
+def store_dict(dict, addr, compress=None):
+    """Store a dictionary as a json file to the given addr, compressed with compress if given.
     """
     Path(get_path()).mkdir(exist_ok=True)
-    with open(addr, 'w') as f:
+    with _open_compressed(addr, 'wt', compress) as f:
         json.dump(dict, f, indent=4, sort_keys=True)
+    stats.count(c.ST_BYTES, os.path.getsize(addr))
+
+def output_path(filename, fevent, nevents, outtype, suffix="", compress=None):
+    """
+    Get the address of the output file for outtype, or None if the output isn't a file. Sharded
+    NDJSON outputs are stored in a directory, whose address is returned instead.
+    """
+    if outtype == 1: return None
+    if   outtype >= c.NDJTYPE: ext = ""
+    elif outtype >= c.NPZTYPE: ext = ".npz"
+    else:                      ext = json_ext(compress)
+    return os.path.normpath(get_path()+c.OUTPREF+generate_outfilename(filename, fevent, nevents,
+                                                                      ext, suffix))
 
-def load_file(addr, fevent=1, nevents=0):
+def json_ext(compress=None):
+    """Get the extension of a json output compressed with compress, or of an uncompressed one.
+    """
+    return ".json" + (c.COMPRESSIONS[compress][1] if compress is not None else "")
+
+def compression(addr):
+    """Detect the compression format of a file from its first bytes, or None if it's uncompressed.
+    """
+    with open(addr, 'rb') as f:
+        head = f.read(8)
+    for (fmt, (magic, _)) in c.COMPRESSIONS.items():
+        if head.startswith(magic): return fmt
+    return None
+
+def strip_compression(filename):
+    """Remove the extension of a compression format from a filename, if it has one.
+    """
+    for (_, ext) in c.COMPRESSIONS.values():
+        if filename.endswith(ext): return filename[:-len(ext)]
+    return filename
+
+def open_input(addr, binary=False):
+    """
+    Open a GEMC file for reading, decompressing it while it's read if it's compressed. Compressed
+    files can be read and seeked like uncompressed ones, with positions counted in uncompressed
+    bytes, but seeking requires decompressing everything before the new position.
+    :param addr:   address of the input file.
+    :param binary: whether to open the file in binary mode instead of text mode.
+    :return:       the open file.
+    """
+    return _open_compressed(addr, 'rb' if binary else 'rt', compression(addr))
+
+def _open_compressed(addr, mode, fmt):
+    """Open a file compressed with fmt, as one of the COMPRESSIONS, or uncompressed if fmt is None.
+    """
+    if fmt is None:   return open(addr, mode)
+    if fmt == c.GZIP: return gzip.open(addr, mode, compresslevel=c.GZIPLEVEL)
+    if fmt == c.BZ2:  return bz2.open(addr, mode)
+    return lzma.open(addr, mode)
+
+def find_inputs(addr):
+    """
+    Find the gemc files referred to by addr.
+    :param addr: address of a gemc file, of a directory with gemc files, or a glob pattern.
+    :return:     a 2-tuple with whether addr refers to a batch of files (0), being a directory or
+                 pattern, and the list of addresses of the gemc files found (1).
+    """
+    if os.path.isdir(addr):
+        exts = [c.GEMCEXT] + [c.GEMCEXT + ext for (_, ext) in c.COMPRESSIONS.values()]
+        return (True, sorted(f for ext in exts for f in glob.glob(os.path.join(addr, "*" + ext))))
+    if glob.escape(addr) != addr: return (True, sorted(f for f in glob.glob(addr)
+                                                       if os.path.isfile(f)))
+    return (False, [addr])
+
+def file_size(addr):
+    """Get the size of a file in bytes.
+    """
+    return os.path.getsize(addr)
+
+def store_stats(summary, addr):
+    """Store a stats summary, as returned by stats.summary(), as a json file to the given addr.
+    """
+    with open(addr, 'w') as f:
+        json.dump(summary, f, indent=4, sort_keys=True)
+
+def load_metadata(addr):
+    """Store a GEMC file's metadata as a dictionary of strings.
+    """
+    with open_input(addr) as f:
+        return fh.store_metadata(f)
+
+def load_file(addr, fevent=1, nevents=0, index=None, typed=False, mapped=False, efilter=None):
     """
     Store a GEMC file's metadata and events in a tuple.
     :param addr:    address of the input file in standard GEMC txt format.
     :param fevent:  first event to read. Useful when handling very large files.
     :param nevents: number of events to read. Set to 0 to read all events from fevent onward.
+    :param index:   event index of the file, as returned by load_index(). If given, the file is read
+                    directly from fevent instead of parsing every event before it.
+    :param typed:   whether to store the raw and digitized banks as typed arrays, as described in
+                    the store_event() method.
+    :param mapped:  whether to memory-map the file and read events with parse_event() instead of
+                    reading them line by line.
+    :param efilter: EventFilter that events must pass to be parsed, or None. Rejected events are
+                    kept as None, so that the rest keep their place.
     :return:        a 2-tuple with a dictionary containing the file's metadata (0) and an array of
                     events (1). Both the metadata's and each event's formats are described in the
                     store_metadata() and store_event() methods.
     """
-    with open(addr) as f:
-        metadata = fh.store_metadata(f)
-        events  = []
+    (metadata, events) = stream_file(addr, fevent, nevents, index, typed, mapped, efilter)
+    return (metadata, list(events))
 
+def stream_file(addr, fevent=1, nevents=0, index=None, typed=False, mapped=False, efilter=None,
+                offset=None, positions=None):
+    """
+    Store a GEMC file's metadata and return a generator over its events, so that only one event is
+    kept in memory at a time.
+    :param addr:      address of the input file in standard GEMC txt format.
+    :param fevent:    first event to read. Useful when handling very large files.
+    :param nevents:   number of events to read. Set to 0 to read all events from fevent onward.
+    :param index:     event index of the file, as returned by load_index(). If given, the file is
+                      read directly from fevent instead of parsing every event before it.
+    :param typed:     whether to store the raw and digitized banks as typed arrays, as described in
+                      the store_event() method.
+    :param mapped:    whether to memory-map the file and read events with parse_event() instead of
+                      reading them line by line. Ignored for compressed files.
+    :param efilter:   EventFilter that events must pass to be parsed, or None. Rejected events are
+                      yielded as None, so that the rest keep their place.
+    :param offset:    position of the file to read events from, as appended to positions by a
+                      previous call, instead of reading from fevent. Overrides index.
+    :param positions: list or deque to which the position where the file continues after each
+                      yielded event is appended, or None.
+    :return:          a 2-tuple with a dictionary containing the file's metadata (0) and a generator
+                      yielding events (1). The file is closed once the generator is exhausted.
+    """
+    f = open_input(addr)
+    metadata = fh.store_metadata(f)
+    if offset is not None:
+        f.seek(offset)
+        fevent = 1
+    elif index is not None:
+        offsets = index[c.S_IDXEVENTS]
+        f.seek(offsets[min(fevent, len(offsets))-1])
+        fevent = 1
+    if mapped and compression(addr) is None:
+        pos = f.tell()
+        f.close()
+        f = MappedFile(addr, pos)
+    return (metadata, _stream_events(f, fevent, nevents, typed, efilter, positions))
+
+def _stream_events(f, fevent, nevents, typed, efilter=None, positions=None):
+    """Yield events from f, with its metadata already stored.
+    """
+    with f:
         ei = 0
         while True:
-            event = fh.store_event(f)
-            if not event: break # Reached end of file.
+            event = _read_event(f, typed, efilter)
+            if not event: break
             ei += 1
             if ei < fevent: continue # Dump events before first to be read.
-            events.append(event)
+            if positions is not None: positions.append(f.tell())
+            yield event if event is not fh.FILTERED else None
             if nevents != 0 and ei-fevent+1 >= nevents: break
 
-    return (metadata, events)
+def _read_event(f, typed, efilter=None):
+    """Store the next event in f, keeping track of the time spent reading and of filtered events.
+    """
+    with stats.timer(c.ST_READ):
+        if isinstance(f, MappedFile): event = f.read_event(typed, efilter)
+        else:                         event = fh.store_event(f, typed, efilter)
+    if event: stats.count(c.ST_EVENTS)
+    if event is fh.FILTERED: stats.count(c.ST_FILTERED)
+    return event
+
+def stream_range(addr, start, end, typed=False, mapped=False, efilter=None):
+    """
+    Yield the events stored between two byte offsets of a GEMC file.
+    :param addr:    address of the input file in standard GEMC txt format.
+    :param start:   byte offset where the first event starts, as stored in the file's index.
+    :param end:     byte offset where the last event ends, as stored in the file's index.
+    :param typed:   whether to store the raw and digitized banks as typed arrays, as described in
+                    the store_event() method.
+    :param mapped:  whether to memory-map the file and read events with parse_event(). Ignored for
+                    compressed files.
+    :param efilter: EventFilter that events must pass to be parsed, or None. Rejected events are
+                    yielded as None.
+    :return:        a generator of events in the format defined by the store_event() method.
+    """
+    f = MappedFile(addr, start) if mapped and compression(addr) is None else open_input(addr)
+    with f:
+        f.seek(start)
+        while f.tell() < end:
+            event = _read_event(f, typed, efilter)
+            if not event: break
+            yield event if event is not fh.FILTERED else None
+
+class MappedFile:
+    """
+    Memory-maps a GEMC file to read its events with parse_event(), keeping track of the position of
+    the next event as a file would.
+    """
+    def __init__(self, addr, pos=0):
+        """Map the file at addr, with its next event starting at byte pos.
+        """
+        self.file = open(addr, 'rb')
+        self.buf  = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if os.fstat(self.file.fileno()).st_size else b""
+        self.pos  = pos
+
+    def read_event(self, typed=False, efilter=None):
+        """Store the next event, as store_event() does.
+        """
+        (event, self.pos) = fh.parse_event(self.buf, self.pos, typed, efilter)
+        return event
+
+    def tell(self):
+        return self.pos
 
-def generate_output(gruidhitsdict, gemchitsdict, metadata, filename, fevent, nevents, outtype=0):
+    def seek(self, pos):
+        self.pos = pos
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap): self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def index_path(addr):
+    """Get the path to the index sidecar of a GEMC file or of an indexed .json output.
+    """
+    return addr + c.INDEXSUFF
+
+def build_index(addr):
+    """
+    Find where the metadata and each event of a GEMC file end, without parsing any of the events.
+    :param addr: address of the input file in standard GEMC txt format.
+    :return:     a dictionary with the size (S_IDXSIZE) and modification time (S_IDXMTIME) of the
+                 file when it was indexed, the byte offset where its metadata ends (S_IDXMETAEND),
+                 and a list with the byte offset where each event starts followed by the offset
+                 where the last one ends (S_IDXEVENTS). Offsets of compressed files are counted in
+                 uncompressed bytes.
+    """
+    stat = os.stat(addr)
+    with open_input(addr) as f:
+        fh.store_metadata(f)
+        pos = f.tell()
+    index = {c.S_IDXSIZE: stat.st_size, c.S_IDXMTIME: stat.st_mtime_ns, c.S_IDXMETAEND: pos,
+             c.S_IDXEVENTS: [pos]}
+
+    # Apply the same stopping conditions as store_event(), but working with raw bytes.
+    eoe = c.S_EOE.encode()
+    with open_input(addr, binary=True) as f:
+        f.seek(pos)
+        for l in f:
+            pos += len(l)
+            l = l[:-1].rstrip()
+            if l == eoe: index[c.S_IDXEVENTS].append(pos)
+            elif not l:  break
+    return index
+
+def load_index(addr):
+    """
+    Load the event index of a GEMC file from its sidecar, or build it and store it in the sidecar if
+    it doesn't exist or if the file changed since it was indexed.
+    :param addr: address of the input file in standard GEMC txt format.
+    :return:     the file's index, in the format defined by the build_index() method.
+    """
+    stat = os.stat(addr)
+    try:
+        with open(index_path(addr)) as f:
+            index = json.load(f)
+        if index[c.S_IDXSIZE] == stat.st_size and index[c.S_IDXMTIME] == stat.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_index(addr)
+    try:
+        with open(index_path(addr), 'w') as f:
+            json.dump(index, f)
+    except OSError:
+        pass # Indexing still works if the sidecar can't be written, it just isn't reused.
+    return index
+
+def split_index(index, fevent, nevents, size):
+    """
+    Split the events to be read from an indexed GEMC file into byte ranges, so that each range can
+    be read independently with stream_range().
+    :param index:   the file's index, as returned by load_index().
+    :param fevent:  first event to read.
+    :param nevents: number of events to read. Set to 0 to read all events from fevent onward.
+    :param size:    maximum number of events in each range.
+    :return:        a list of 3-tuples with the event number of the first event in the range (0) and
+                    the byte offsets where the range starts (1) and ends (2).
+    """
+    offsets = index[c.S_IDXEVENTS]
+    levent  = len(offsets)-1
+    if nevents != 0: levent = min(levent, fevent+nevents-1)
+    return [(ei, offsets[ei-1], offsets[min(ei+size-1, levent)])
+            for ei in range(fevent, levent+1, size)]
+
+def file_id(addr):
+    """Identify a file by its absolute path, size and modification time, to detect changes.
+    """
+    stat = os.stat(addr)
+    return (os.path.abspath(addr), stat.st_size, stat.st_mtime_ns)
+
+def _cache_entry(cachedir, key):
+    """Get the address of the cache entry for key, which can be any tuple with a stable repr.
+    """
+    key = (c.CACHEVERSION,) + key
+    return os.path.join(cachedir, hashlib.sha1(repr(key).encode()).hexdigest() + c.CACHESUFF)
+
+def load_cached(cachedir, key):
+    """
+    Load an object from the translation cache. Entries that are loaded are marked as recently used,
+    so that they're evicted last.
+    :param cachedir: path to the cache directory.
+    :param key:      tuple identifying the object, as given to store_cached().
+    :return:         the stored object, or None if it isn't in the cache.
+    """
+    addr = _cache_entry(cachedir, key)
+    try:
+        with open(addr, 'rb') as f:
+            value = pickle.load(f)
+        os.utime(addr)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        stats.count(c.ST_CACHEMISS)
+        return None
+    stats.count(c.ST_CACHEHIT)
+    return value
+
+def store_cached(cachedir, key, value):
+    """
+    Store an object in the translation cache. Entries are written to a temporary file first, so that
+    parallel workers never read a partially written entry.
+    :param cachedir: path to the cache directory.
+    :param key:      tuple identifying the object.
+    :param value:    object to be stored. Should be picklable.
+    """
+    addr = _cache_entry(cachedir, key)
+    tmp  = addr + "." + str(os.getpid())
+    try:
+        Path(cachedir).mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, addr)
+    except OSError:
+        pass # A cache that can't be written is just a cache that always misses.
+
+def evict_cache(cachedir, maxsize):
+    """
+    Remove the least recently used entries from the translation cache until its size is at most
+    maxsize.
+    :param cachedir: path to the cache directory.
+    :param maxsize:  maximum size of the cache in bytes.
+    """
+    try:
+        entries = [(e.stat().st_mtime_ns, e.stat().st_size, e.path) for e in os.scandir(cachedir)
+                   if e.name.endswith(c.CACHESUFF)]
+    except OSError:
+        return
+    size = sum(e[1] for e in entries)
+    for (_, esize, addr) in sorted(entries):
+        if size <= maxsize: break
+        try:
+            os.remove(addr)
+        except OSError:
+            continue
+        size -= esize
+
+def checkpoint_path(filename, fevent, nevents):
+    """Get the address of the checkpoint of a run, stored next to its outputs.
+    """
+    return os.path.normpath(get_path()+c.OUTPREF+generate_outfilename(filename, fevent, nevents,
+                                                                      c.CKPTSUFF))
+
+def load_checkpoint(addr):
+    """Load a checkpoint as a dictionary, or None if there's none at addr.
+    """
+    try:
+        with open(addr) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def store_checkpoint(addr, checkpoint):
+    """
+    Store a checkpoint, replacing the previous one only once it's entirely on disk, so that a run
+    interrupted while storing it still has the previous one.
+    """
+    Path(get_path()).mkdir(exist_ok=True)
+    tmp = addr + "." + str(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, addr)
+
+def remove_checkpoint(addr):
+    """Remove the checkpoint of a run once it's finished.
+    """
+    try:
+        os.remove(addr)
+    except OSError:
+        pass
+
+def _sync(addr):
+    """Make sure that everything written to a closed file is on disk.
+    """
+    with open(addr, 'rb') as f:
+        os.fsync(f.fileno())
+
+def _reopen(addr, size, compress):
+    """
+    Open an output to append to it after truncating it to size, the size it had at a checkpoint.
+    Compressed outputs are continued as a new stream in the same file, which is read as if they
+    were a single stream.
+    """
+    os.truncate(addr, size)
+    return _open_compressed(addr, 'at', compress)
+
+def generate_output(gruidhitsdict, gemchitsdict, metadata, filename, fevent, nevents, outtype=0,
+                    suffix="", compress=None, indexed=False, shard=None):
     """Calls appropiate output function based in outtype.
     """
-    outfname = generate_outfilename(filename, fevent, nevents)
+    if outtype >= c.NPZTYPE:
+        with open_stream(metadata, filename, fevent, nevents, outtype, suffix, compress,
+                         shard=shard) as out:
+            for key in gruidhitsdict: out.write(key, gruidhitsdict[key], gemchitsdict[key])
+        return
+    if indexed and outtype != 1:
+        with EventStream(metadata, filename, fevent, nevents, outtype, suffix, compress,
+                         indexed) as out:
+            for key in sorted(gruidhitsdict): out.write(key, gruidhitsdict[key], gemchitsdict[key])
+        return
+    outfname = generate_outfilename(filename, fevent, nevents, json_ext(compress), suffix)
     switch = [_export0, _export1, _export2, _export3, _export4]
-    switch[outtype-1](gruidhitsdict, gemchitsdict, metadata, outfname)
+    switch[outtype-1](gruidhitsdict, gemchitsdict, metadata, outfname, compress)
+
+def open_stream(metadata, filename, fevent, nevents, outtype, suffix="", compress=None,
+                indexed=False, shard=None, state=None, budget=None):
+    """
+    Open the incremental writer appropiate for outtype, resuming it from the state it returned at a
+    checkpoint if given. Only EventStream and ShardStream can be resumed. If a budget is given, the
+    .json outputs are written sorted by key with a SpillStream instead.
+    """
+    if budget is not None and outtype < c.NPZTYPE:
+        return SpillStream(metadata, filename, fevent, nevents, outtype, suffix, compress, indexed,
+                           budget)
+    if outtype >= c.NDJTYPE:
+        return ShardStream(metadata, filename, fevent, nevents, outtype, suffix, compress, shard,
+                           state)
+    if outtype >= c.NPZTYPE: return NpzStream(metadata, filename, fevent, nevents, outtype, suffix)
+    return EventStream(metadata, filename, fevent, nevents, outtype, suffix, compress, indexed,
+                       state)
+
+def merge_event(gruidhits, gemchits, outtype):
+    """Merge an event's gruid and gemc hits into the entry stored in the output for outtype.
+    """
+    if outtype <= 2: return gruidhits
+    if outtype == 3: return gruidhits | {c.S_MASSHITS: gemchits.tolists(c.S_MASSHITS)}
+    return gruidhits | {key: gemchits.tolists(key) for key in gemchits}
 
-def _export0(gruidhitsdict, gemchitsdict, metadata, filename):
+def _export0(gruidhitsdict, gemchitsdict, metadata, filename, compress=None):
     """Print gruidhitsdict to stdout.
     """
-    print(json.dumps(gruidhitsdict, indent=4, sort_keys=True))
+    out = json.dumps(gruidhitsdict, indent=4, sort_keys=True)
+    print(out)
+    stats.count(c.ST_BYTES, len(out)+1)
 
-def _export1(gruidhitsdict, gemchitsdict, metadata, filename):
+def _export1(gruidhitsdict, gemchitsdict, metadata, filename, compress=None):
     """Save gruidhitsdict in a json file.
     """
-    store_dict(gruidhitsdict, get_path()+c.OUTPREF+filename)
+    store_dict(gruidhitsdict, get_path()+c.OUTPREF+filename, compress)
 
-def _export2(gruidhitsdict, gemchitsdict, metadata, filename):
+def _export2(gruidhitsdict, gemchitsdict, metadata, filename, compress=None):
     """Save gruidhits and muon hits to a json file.
     """
     eventdict = {}
     for key in gruidhitsdict:
-        eventdict[key] = gruidhitsdict[key]
-        eventdict[key][c.S_MASSHITS] = gemchitsdict[key][c.S_MASSHITS]
-    store_dict(eventdict, get_path()+c.OUTPREF+filename)
+        eventdict[key] = merge_event(gruidhitsdict[key], gemchitsdict[key], 3)
+    store_dict(eventdict, get_path()+c.OUTPREF+filename, compress)
 
-def _export3(gruidhitsdict, gemchitsdict, metadata, filename):
+def _export3(gruidhitsdict, gemchitsdict, metadata, filename, compress=None):
     """Save all hit data to json file.
     """
     eventdict = {}
     for key in gruidhitsdict:
-        eventdict[key] = gruidhitsdict[key] | gemchitsdict[key]
-    store_dict(eventdict, get_path()+c.OUTPREF+filename)
+        eventdict[key] = merge_event(gruidhitsdict[key], gemchitsdict[key], 4)
+    store_dict(eventdict, get_path()+c.OUTPREF+filename, compress)
 
-def _export4(gruidhitsdict, gemchitsdict, metadata, filename):
+def _export4(gruidhitsdict, gemchitsdict, metadata, filename, compress=None):
     """Save all hit data and gemc metadata to json file.
     """
     eventdict = {}
     eventdict[c.S_GEMCMETA] = metadata
     for key in gruidhitsdict:
-        eventdict[key] = gruidhitsdict[key] | gemchitsdict[key]
-    store_dict(eventdict, get_path()+c.OUTPREF+filename)
+        eventdict[key] = merge_event(gruidhitsdict[key], gemchitsdict[key], 5)
+    store_dict(eventdict, get_path()+c.OUTPREF+filename, compress)
+
+class EventStream:
+    """
+    Writes the same output as generate_output(), but one event at a time as soon as each is
+    translated, so that a run never holds more than one event in memory. Events are written in the
+    order they're given instead of being sorted by key, which has no effect on the loaded .json.
+    If indexed, an index of where each event, section and time step is stored is kept and stored
+    next to the output, as described in the dump_entry() method.
+    """
+    def __init__(self, metadata, filename, fevent, nevents, outtype, suffix="", compress=None,
+                 indexed=False, state=None):
+        """
+        Open the output for writing.
+        :param metadata: metadata of the gemc file, as returned by store_metadata().
+        :param filename: name of the gemc file.
+        :param fevent:   first event read from the gemc file.
+        :param nevents:  number of events read from the gemc file.
+        :param outtype:  type of output to be generated, as defined in the README.
+        :param suffix:   string added to the output filename, before its extension.
+        :param compress: compression format of the output file, as one of the COMPRESSIONS, or
+                         None to leave it uncompressed.
+        :param indexed:  whether to store an index next to the output. Ignored for stdout.
+        :param state:    state returned by checkpoint(), to append to an output written up to then
+                         instead of starting over, or None. Can't be used with stdout.
+        """
+        self.outtype  = outtype
+        self.compress = compress
+        self.nentries = 0
+        self.pos      = 0
+        self.index    = {} if indexed and outtype != 1 else None
+        if outtype == 1:
+            self.file = sys.stdout
+        else:
+            Path(get_path()).mkdir(exist_ok=True)
+            self.addr = output_path(filename, fevent, nevents, outtype, suffix, compress)
+            if state is None:
+                self.file = _open_compressed(self.addr, 'wt', compress)
+            else:
+                self.file     = _reopen(self.addr, state[c.S_CKSIZE], compress)
+                self.nentries = state[c.S_CKENTRIES]
+                self.pos      = state[c.S_CKPOS]
+                if self.index is not None: self.index = state[c.S_CKINDEX]
+        if outtype == 5 and state is None: self._write_entry(c.S_GEMCMETA, metadata)
+
+    def write(self, key, gruidhits, gemchits):
+        """Write one translated event under key.
+        """
+        self._write_entry(key, merge_event(gruidhits, gemchits, self.outtype))
+
+    def checkpoint(self):
+        """
+        Make sure that everything written until now is on disk.
+        :return: the state of the output, given to the constructor to resume writing from here.
+        """
+        if self.compress is None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        else:
+            # Finish the compressed stream, so that the output can be decompressed up to here.
+            self.file.close()
+            _sync(self.addr)
+            self.file = _open_compressed(self.addr, 'at', self.compress)
+        state = {c.S_CKSIZE: os.path.getsize(self.addr), c.S_CKENTRIES: self.nentries,
+                 c.S_CKPOS: self.pos}
+        if self.index is not None: state[c.S_CKINDEX] = self.index
+        return state
+
+    def close(self):
+        """Close the json object and the output file.
+        """
+        self._write("\n}" if self.nentries else "{}")
+        if self.outtype == 1:
+            self._write("\n")
+        else:
+            self.file.close()
+            stats.count(c.ST_BYTES, os.path.getsize(self.addr))
+            if self.index is not None: store_output_index(self.addr, self.index)
+
+    def write_entry(self, key, entry, index=None):
+        """
+        Write one key of the top-level json object, already formatted by dump_entry().
+        :param key:   key of the entry.
+        :param entry: formatted entry.
+        :param index: index of the entry, as returned by dump_entry() for position 0. Only needed if
+                      the output is indexed.
+        """
+        self._write(",\n" if self.nentries else "{\n")
+        if self.index is not None: self.index[key] = _shift_index(index, self.pos)
+        self._write(entry)
+        self.nentries += 1
+
+    def _write_entry(self, key, value):
+        """Write one key of the top-level json object, formatted as json.dump() would.
+        """
+        self._write(",\n" if self.nentries else "{\n")
+        if self.index is None:
+            self._write(json.dumps({key: value}, indent=4, sort_keys=True)[2:-2])
+        else:
+            (entry, self.index[key]) = dump_entry(key, value, self.pos)
+            self._write(entry)
+        self.nentries += 1
+
+    def _write(self, s):
+        """Write a string to the output, counting its size if it's stdout.
+        """
+        self.file.write(s)
+        self.pos += len(s)
+        if self.outtype == 1: stats.count(c.ST_BYTES, len(s))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Sections of a gruid event whose time steps are indexed by dump_entry().
+_TSERIES = {c.S_GRUIDH1, c.S_GRUIDH2, c.S_GRUIDHB, c.S_DPLANE}
+
+def dump_entry(key, value, pos=0):
+    """
+    Format one key of a top-level json object as json.dump() does with indent=4 and sort_keys, while
+    finding where the value of the key, of each of its sections and of each time step of its time
+    series start and end. The formatted entry is the same as the one written without an index.
+    :param key:   key of the entry.
+    :param value: value of the entry. If it's a dictionary, its keys are taken as sections.
+    :param pos:   position in the output where the entry is written.
+    :return:      a 2-tuple with the formatted entry (0), without the comma or newline separating
+                  it from the previous one, and its index (1). The index is a dictionary with the
+                  start and end of the value (S_IDXSPAN) and, for dictionaries, with the index of
+                  each section (S_IDXSECTS). The index of a section has its own S_IDXSPAN and, for
+                  time series, a list with the json key, start and end of each time step
+                  (S_IDXSTEPS), in the order they're stored.
+    """
+    parts = []
+    def add(s):
+        nonlocal pos
+        parts.append(s)
+        pos += len(s)
+
+    add(" "*4 + _json_key(key) + ": ")
+    index = {c.S_IDXSPAN: [pos, None]}
+    if isinstance(value, dict) and value:
+        index[c.S_IDXSECTS] = {}
+        add("{")
+        for (si, (section, svalue)) in enumerate(sorted(value.items())):
+            add(("," if si else "") + "\n" + " "*8 + _json_key(section) + ": ")
+            sindex = {c.S_IDXSPAN: [pos, None]}
+            if section in _TSERIES and isinstance(svalue, dict) and svalue:
+                sindex[c.S_IDXSTEPS] = []
+                add("{")
+                for (ti, (t, tvalue)) in enumerate(sorted(svalue.items())):
+                    tkey = _json_key(t)
+                    add(("," if ti else "") + "\n" + " "*12 + tkey + ": ")
+                    start = pos
+                    add(_json_value(tvalue, 3))
+                    sindex[c.S_IDXSTEPS].append([tkey[1:-1], start, pos])
+                add("\n" + " "*8 + "}")
+            else:
+                add(_json_value(svalue, 2))
+            sindex[c.S_IDXSPAN][1] = pos
+            index[c.S_IDXSECTS][section] = sindex
+        add("\n" + " "*4 + "}")
+    else:
+        add(_json_value(value, 1))
+    index[c.S_IDXSPAN][1] = pos
+    return ("".join(parts), index)
+
+def _shift_index(index, offset):
+    """Move the index of an entry, or of one of its sections, built by dump_entry() by offset.
+    """
+    shifted = {c.S_IDXSPAN: [pos+offset for pos in index[c.S_IDXSPAN]]}
+    if c.S_IDXSECTS in index:
+        shifted[c.S_IDXSECTS] = {section: _shift_index(sindex, offset)
+                                 for (section, sindex) in index[c.S_IDXSECTS].items()}
+    if c.S_IDXSTEPS in index:
+        shifted[c.S_IDXSTEPS] = [[tkey, start+offset, end+offset]
+                                 for (tkey, start, end) in index[c.S_IDXSTEPS]]
+    return shifted
+
+def _json_key(key):
+    """Format a dictionary key as json.dump() does, quotes included.
+    """
+    return json.dumps({key: 0})[1:-4]
+
+def _json_value(value, depth):
+    """Format a value nested depth levels deep as json.dump() does with indent=4 and sort_keys.
+    """
+    return json.dumps(value, indent=4, sort_keys=True).replace("\n", "\n" + " "*(4*depth))
+
+def store_output_index(addr, entries):
+    """Store the index of a .json output, with the indexes of its entries as built by dump_entry().
+    """
+    stat = os.stat(addr)
+    with open(index_path(addr), 'w') as f:
+        json.dump({c.S_IDXSIZE: stat.st_size, c.S_IDXMTIME: stat.st_mtime_ns,
+                   c.S_IDXEVENTS: entries}, f)
+
+class OutputReader:
+    """
+    Reads a .json output written with an index, decoding only the entries, sections and time steps
+    that are requested instead of the whole file. Outputs can be compressed, but seeking in them
+    requires decompressing everything before each requested entry.
+    """
+    def __init__(self, addr):
+        """
+        Open an output and load its index.
+        :param addr: address of the .json output.
+        :raises OSError:    if the output or its index can't be read.
+        :raises ValueError: if the index is malformed or the output changed since it was indexed.
+        """
+        stat = os.stat(addr)
+        try:
+            with open(index_path(addr)) as f:
+                index = json.load(f)
+        except OSError as e:
+            raise OSError(addr + " has no index") from e
+        if not isinstance(index, dict) or any(k not in index for k in (c.S_IDXSIZE, c.S_IDXMTIME,
+                                                                         c.S_IDXEVENTS)):
+            raise ValueError(index_path(addr) + " isn't the index of a .json output")
+        if index[c.S_IDXSIZE] != stat.st_size or index[c.S_IDXMTIME] != stat.st_mtime_ns:
+            raise ValueError(addr + " changed since it was indexed")
+        self.entries = index[c.S_IDXEVENTS]
+        self.file    = open_input(addr, binary=True)
+
+    def keys(self):
+        """Get the keys of all entries, as stored in the output.
+        """
+        return list(self.entries)
+
+    def sections(self, key):
+        """Get the sections of an entry.
+        """
+        return list(self.entries[key].get(c.S_IDXSECTS, {}))
+
+    def times(self, key, section):
+        """Get the instants of time of each time step in a time series of an entry.
+        """
+        return [float(step[0]) for step in self._section(key, section).get(c.S_IDXSTEPS, [])]
+
+    def load(self, key, section=None, tmin=None, tmax=None):
+        """
+        Decode an entry, one of its sections, or the time steps of a time series in a time window.
+        :param key:     key of the entry.
+        :param section: section of the entry to decode, or None to decode the entire entry.
+        :param tmin:    if given, only time steps starting at tmin or later are decoded.
+        :param tmax:    if given, only time steps starting before tmax are decoded.
+        :return:        the decoded value, as json.load() would return it. Time windows return a
+                        dictionary with the json key of each time step in the window.
+        """
+        if section is None: return self._decode(self.entries[key][c.S_IDXSPAN])
+        sindex = self._section(key, section)
+        if (tmin is None and tmax is None) or c.S_IDXSTEPS not in sindex:
+            return self._decode(sindex[c.S_IDXSPAN])
+        return {step[0]: self._decode(step[1:]) for step in sindex[c.S_IDXSTEPS]
+                if (tmin is None or float(step[0]) >= tmin)
+                and (tmax is None or float(step[0]) < tmax)}
+
+    def _section(self, key, section):
+        """Get the index of a section of an entry.
+        """
+        return self.entries[key][c.S_IDXSECTS][section]
+
+    def _decode(self, span):
+        """Decode the json value stored between two positions of the output.
+        """
+        self.file.seek(span[0])
+        return json.loads(self.file.read(span[1]-span[0]))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ShardStream:
+    """
+    Writes the same data as the .json outputs, but as one compact json record per line (NDJSON)
+    split into shards that can be read in parallel. Each record is the event's entry in the .json
+    output with its key added as S_EVENT, without indentation or sorted keys. Shards are stored in a
+    directory named as the .json output would be, together with a manifest listing the events in
+    each shard and its size before compression.
+    """
+    def __init__(self, metadata, filename, fevent, nevents, outtype, suffix="", compress=None,
+                 shard=None, state=None):
+        """
+        Prepare the output. Parameters are the same as EventStream's, plus:
+        :param shard: 2-tuple with the maximum number of events (0) and of bytes before compression
+                      (1) stored in each shard, either being 0 for no limit. If None, the defaults
+                      SHARDEVENTS and SHARDSIZE are used.
+        :param state: state returned by checkpoint(), to append to the shards written up to then
+                      instead of starting over, or None.
+        """
+        if shard is None: shard = (c.SHARDEVENTS, c.SHARDSIZE*10**6)
+        self.metadata = metadata
+        self.variant  = outtype - c.NDJTYPE + 2 # Equivalent json outtype.
+        self.compress = compress
+        self.limits   = shard
+        self.addr     = output_path(filename, fevent, nevents, outtype, suffix)
+        self.shards   = []
+        self.file     = None
+        Path(self.addr).mkdir(parents=True, exist_ok=True)
+        if state is not None and state[c.S_MSHARDS]:
+            self.shards = state[c.S_MSHARDS]
+            self.file   = _reopen(self._shard_path(), state[c.S_CKSIZE], compress)
+
+    def write(self, key, gruidhits, gemchits):
+        """Write one translated event under key, starting a new shard if the current one is full.
+        """
+        record = {c.S_EVENT: key} | merge_event(gruidhits, gemchits, self.variant)
+        line   = json.dumps(record, separators=(',', ':')) + "\n"
+        if self.file is None or self._full(): self._next_shard()
+        self.file.write(line)
+        shard = self.shards[-1]
+        shard[c.S_MEVENTS] += 1
+        shard[c.S_MBYTES]  += len(line)
+        shard[c.S_MLAST]    = key
+        if shard[c.S_MFIRST] is None: shard[c.S_MFIRST] = key
+
+    def checkpoint(self):
+        """
+        Make sure that every shard written until now is on disk.
+        :return: the state of the output, given to the constructor to resume writing from here.
+        """
+        if self.file is None: return {c.S_MSHARDS: []}
+        self.file.close()
+        _sync(self._shard_path())
+        self.file = _open_compressed(self._shard_path(), 'at', self.compress)
+        return {c.S_MSHARDS: [dict(shard) for shard in self.shards],
+                c.S_CKSIZE: os.path.getsize(self._shard_path())}
+
+    def close(self):
+        """Close the last shard and store the manifest.
+        """
+        self._close_shard()
+        manifest = {c.S_MSHARDS: self.shards,
+                    c.S_MEVENTS: sum(shard[c.S_MEVENTS] for shard in self.shards)}
+        if self.variant == 5: manifest[c.S_GEMCMETA] = self.metadata
+        with open(os.path.join(self.addr, c.MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+    def _full(self):
+        """Check if the current shard reached either of its limits.
+        """
+        shard = self.shards[-1]
+        return (self.limits[0] and shard[c.S_MEVENTS] >= self.limits[0]) or \
+               (self.limits[1] and shard[c.S_MBYTES]  >= self.limits[1])
+
+    def _next_shard(self):
+        """Close the current shard, if any, and open the next one.
+        """
+        self._close_shard()
+        name = c.SHARDPREF + "{:05d}".format(len(self.shards)) + c.NDJEXT
+        if self.compress is not None: name += c.COMPRESSIONS[self.compress][1]
+        self.shards.append({c.S_MFILE: name, c.S_MEVENTS: 0, c.S_MBYTES: 0, c.S_MFIRST: None,
+                            c.S_MLAST: None})
+        self.file = _open_compressed(self._shard_path(), 'wt', self.compress)
+
+    def _shard_path(self):
+        """Get the address of the current shard.
+        """
+        return os.path.join(self.addr, self.shards[-1][c.S_MFILE])
+
+    def _close_shard(self):
+        """Close the current shard, counting its size on disk.
+        """
+        if self.file is None: return
+        self.file.close()
+        self.file = None
+        stats.count(c.ST_BYTES, os.path.getsize(self._shard_path()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SpillStream:
+    """
+    Writes the same output as generate_output() for the .json OUTTYPEs, with events sorted by key,
+    keeping the events formatted in memory only up to a budget. Past it, they're spilled to a
+    temporary segment next to the output, sorted by key, and every segment is merged into the
+    output once it's closed. Outputs with the gemc metadata have it as their first entry instead of
+    sorted with the events, which has no effect on the loaded .json.
+    """
+    def __init__(self, metadata, filename, fevent, nevents, outtype, suffix="", compress=None,
+                 indexed=False, budget=0):
+        """
+        Prepare the output. Parameters are the same as EventStream's, except for budget.
+        :param budget: maximum size of the formatted events kept in memory, in bytes.
+        """
+        self.args     = (metadata, filename, fevent, nevents, outtype, suffix, compress, indexed)
+        self.outtype  = outtype
+        self.indexed  = indexed and outtype != 1
+        self.budget   = budget
+        self.entries  = {}
+        self.size     = 0
+        self.segments = []
+
+    def write(self, key, gruidhits, gemchits):
+        """Format one translated event under key, spilling the events kept if over the budget.
+        """
+        value = merge_event(gruidhits, gemchits, self.outtype)
+        if self.indexed: entry = dump_entry(key, value)
+        else:            entry = (json.dumps({key: value}, indent=4, sort_keys=True)[2:-2], None)
+        self.entries[key] = entry
+        self.size += len(entry[0])
+        if self.size > self.budget: self._spill()
+
+    def close(self):
+        """Merge the spilled segments and the events kept in memory into the output.
+        """
+        runs = []
+        for segment in self.segments:
+            segment.seek(0)
+            runs.append(map(json.loads, segment))
+        runs.append([key, *self.entries[key]] for key in sorted(self.entries))
+        with EventStream(*self.args) as out:
+            for (key, entry, index) in heapq.merge(*runs, key=lambda line: line[0]):
+                out.write_entry(key, entry, index)
+        for segment in self.segments: segment.close()
+
+    def _spill(self):
+        """Store the events kept in memory in a new temporary segment, one per line.
+        """
+        Path(get_path()).mkdir(exist_ok=True)
+        segment = tempfile.TemporaryFile('w+t', dir=get_path(), prefix=c.OUTPREF,
+                                         suffix=c.SPILLSUFF)
+        for key in sorted(self.entries):
+            segment.write(json.dumps([key, *self.entries[key]]) + "\n")
+        self.segments.append(segment)
+        self.entries = {}
+        self.size    = 0
+        stats.count(c.ST_SPILLED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Columns stored for each section of the .npz output, with their types. Time series and the
+# detecting plane use the same columns as generate_arrays().
+_GRUIDMETA_FIELDS = [(c.S_PID, 0), (c.S_DT, 0.), (c.S_DX, 0.), (c.S_DY, 0.), (c.S_NROWS, 0),
+                     (c.S_NCOLS, 0), (c.S_DZ, float("nan")), (c.S_NDCOLS, 0),
+                     (c.S_AGGREGATED, False)]
+_HIT_COLUMNS   = [(c.S_N, numpy.int64), (c.S_ID, numpy.int64), (c.S_PID, numpy.int32),
+                  (c.S_X, numpy.float64), (c.S_Y, numpy.float64), (c.S_Z, numpy.float64),
+                  (c.S_T, numpy.float64), (c.S_ED, numpy.float64), (c.S_TRKE, numpy.float64)]
+
+class NpzStream:
+    """
+    Writes the same data as the .json outputs, but as columnar sparse arrays in a compressed .npz
+    file. Each section of the output is stored as a set of columns named "<section>/<column>", where
+    the S_EVENT column is the position of the hit's event in the S_EVENT array. Time steps are
+    stored as their index in the time series, with t = S_TSTEP*dt. Events are kept as compact arrays
+    until the writer is closed.
+    """
+    def __init__(self, metadata, filename, fevent, nevents, outtype, suffix=""):
+        """Prepare the output. Parameters are the same as EventStream's.
+        """
+        self.metadata = metadata
+        self.variant  = outtype - c.NPZTYPE + 2 # Equivalent json outtype.
+        self.addr     = output_path(filename, fevent, nevents, outtype, suffix)
+        self.keys     = []
+        self.columns  = {}
+
+    def write(self, key, gruidhits, gemchits):
+        """Convert one translated event to columns and store them under key.
+        """
+        for (name, col) in _event_columns(len(self.keys), gruidhits, gemchits, self.variant):
+            if name not in self.columns: self.columns[name] = []
+            self.columns[name].append(col)
+        self.keys.append(key)
+
+    def close(self):
+        """Store all events in the .npz file.
+        """
+        arrays = {name: numpy.concatenate(cols) for (name, cols) in self.columns.items()}
+        arrays[c.S_EVENT] = numpy.array(self.keys, dtype=str)
+        if self.variant == 5: arrays[c.S_GEMCMETA] = numpy.array(json.dumps(self.metadata))
+        Path(get_path()).mkdir(exist_ok=True)
+        numpy.savez_compressed(self.addr, **arrays)
+        stats.count(c.ST_BYTES, os.path.getsize(self.addr))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _event_columns(ei, gruidhits, gemchits, variant):
+    """
+    Convert one event to columns, in the format described by NpzStream.
+    :param ei:        position of the event in the output.
+    :param gruidhits: gruid event, as returned by generate_arrays().
+    :param gemchits:  gemc hits, as returned by extract_hits().
+    :param variant:   json outtype whose data should be stored.
+    :return:          a generator of 2-tuples with each column's name (0) and values (1).
+    """
+    meta = gruidhits[c.S_GRUIDMETA]
+    for (field, default) in _GRUIDMETA_FIELDS:
+        yield (c.S_GRUIDMETA + '/' + field, numpy.array([meta.get(field, default)]))
+
+    # Gruid time series and massive particles crossing the detecting plane, already stored as
+    # columns by generate_arrays().
+    for section in (c.S_GRUIDH1, c.S_GRUIDH2, c.S_GRUIDHB, c.S_DPLANE):
+        if section not in gruidhits: continue
+        cols = gruidhits[section]
+        yield (section + '/' + c.S_EVENT, numpy.full(cols[c.S_TSTEP].size, ei, dtype=numpy.int32))
+        for (name, col) in cols.items(): yield (section + '/' + name, col)
+
+    # Gemc hits.
+    hitkeys = []
+    if variant == 3: hitkeys = [c.S_MASSHITS]
+    if variant >= 4: hitkeys = list(gemchits.keys())
+    for key in hitkeys:
+        hits = gemchits[key]
+        yield (key + '/' + c.S_EVENT, numpy.full(gemchits.count(key), ei, dtype=numpy.int32))
+        for (col, dtype) in _HIT_COLUMNS:
+            yield (key + '/' + col, hits[col].astype(dtype))
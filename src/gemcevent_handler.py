@@ -7,18 +7,94 @@
 Handles GEMC events. Currently only extracts the relevant hits for an event.
 """
 
-import copy
+import numpy
+
 import constants as c
 
+# Categories of the hits extracted from an event, in the order in which they're stored. Massive
+# particle hits and photon hits outside of the endplates are next to each other, so that the hits
+# used by the detecting plane are stored together too.
+HITKEYS = [c.S_MASSHITS, c.S_PHOTONHITS, c.S_PHOTONH1, c.S_PHOTONH2]
+# Columns stored for each hit, with their types.
+HITCOLS = [(c.S_N, numpy.int64), (c.S_ID, numpy.int64), (c.S_PID, numpy.int64),
+           (c.S_X, numpy.float64), (c.S_Y, numpy.float64), (c.S_Z, numpy.float64),
+           (c.S_T, numpy.float64), (c.S_ED, numpy.float64), (c.S_TRKE, numpy.float64)]
+# Range of categories in HITKEYS covered by each key of EventHits.
+_SPANS = {key: (i, i+1) for (i, key) in enumerate(HITKEYS)}
+_SPANS[c.S_DPLANE] = (0, 2)
+# PIDs of massive particles, as written in the input file.
+_S_MASSPIDS = {c.S_MMPID, c.S_MPPID, c.S_EMPID, c.S_EPPID, c.S_NPID}
+
+class EventHits:
+    """
+    Hits extracted from one event, stored as one array per column with the hits of each category
+    next to each other. Works as a read-only dictionary of categories, each being a dictionary of
+    columns, where every column is a view of the stored arrays instead of a copy.
+    """
+    __slots__ = ("columns", "bounds")
+
+    def __init__(self, columns, category):
+        """
+        Store hits grouped by category, keeping their order inside each category.
+        :param columns:  dictionary with the values of each column in HITCOLS for every hit, either
+                         as arrays or as lists of strings.
+        :param category: array with the position in HITKEYS of each hit's category, or -1 for hits
+                         that should be ignored.
+        """
+        counts = numpy.bincount(category+1, minlength=len(HITKEYS)+1)
+        order  = numpy.argsort(category, kind='stable')[counts[0]:]
+        self.columns = {col: numpy.asarray(columns[col], dtype=dtype)[order]
+                        for (col, dtype) in HITCOLS}
+        self.bounds  = [0] + numpy.cumsum(counts[1:]).tolist()
+
+    def __getitem__(self, key):
+        """Get the columns of a category in HITKEYS, or of the hits used by the detecting plane.
+        """
+        (b0, b1) = self.span(key)
+        return {col: arr[b0:b1] for (col, arr) in self.columns.items()}
+
+    def __iter__(self):
+        return iter(HITKEYS)
+
+    def __len__(self):
+        return len(HITKEYS)
+
+    def keys(self):
+        return list(HITKEYS)
+
+    def span(self, key):
+        """Get the first and last+1 positions of a category's hits in the stored columns.
+        """
+        return tuple(self.bounds[i] for i in _SPANS[key])
+
+    def count(self, key):
+        """Get the number of hits in a category.
+        """
+        (b0, b1) = self.span(key)
+        return b1 - b0
+
+    def translatable(self):
+        """Check for massive particle hits and photon hits on the endplates, needed to translate.
+        """
+        return self.count(c.S_MASSHITS) > 0 and \
+               (self.count(c.S_PHOTONH1) > 0 or self.count(c.S_PHOTONH2) > 0)
+
+    def tolists(self, key):
+        """Get the columns of a category as lists, to be stored as json.
+        """
+        return {col: arr.tolist() for (col, arr) in self[key].items()}
+
 def extract_hits(event):
     """
     Extract photon and predefined massive particle hits with energy larger than 0 from an event.
-    :param event: one event in the format defined by the store_event() method.
-    :return:      A dictionary containing 3 dictionaries that describe the hits. The three
-                  dictionaries contain the particle hits --which generate the photons--, and the
-                  photon hits that deposited energy in the endplates. The first is added to the
-                  output of the program, while the two other are used to generate the gruid hits.
-                  The dictionaries' keys are the following:
+    Hits are classified all at once with masks over the PID and volume ID columns.
+    :param event: one event in the format defined by the store_event() method, with its banks
+                  stored either as strings or as typed arrays.
+    :return:      An EventHits with 4 categories of hits. The first contains the particle hits
+                  --which generate the photons--, and the two last the photon hits that deposited
+                  energy in each side's endplates. The first is added to the output of the program,
+                  while the two last are used to generate the gruid hits. Each category's columns
+                  are the following:
                     * n: hit identifier. Unused by this program, but useful in reconstruction.
                     * x: x position of the hit in cm.
                     * y: y position of the hit in cm.
@@ -28,40 +104,45 @@ def extract_hits(event):
                     * TrkE: energy of the track to which the hit belongs.
     """
     if event is None: return None
-    # Define hits dictionaries (one per detecting surface).
-    hitdict = {c.S_N:[], c.S_ID:[], c.S_PID:[], c.S_X:[], c.S_Y:[], c.S_Z:[], c.S_T:[],
-               c.S_ED:[], c.S_TRKE:[]}
-    pidlist = [c.S_MMPID, c.S_MPPID, c.S_EMPID, c.S_EPPID, c.S_NPID]
-    hits = {c.S_MASSHITS:   copy.deepcopy(hitdict),
-            c.S_PHOTONHITS: copy.deepcopy(hitdict),
-            c.S_PHOTONH1:   copy.deepcopy(hitdict),
-            c.S_PHOTONH2:   copy.deepcopy(hitdict),}
-
-    for hi in range(len(event[c.IDBANK][c.S_HITN])):
-        if event[c.IRBANK][c.S_EDEP][hi] == '0': continue # Ignore hits with no energy deposited.
-
-        # Determine hit source.
-        key = None
-        if event[c.IRBANK][c.S_PID][hi] in pidlist:         key = c.S_MASSHITS
-        elif event[c.IRBANK][c.S_PID][hi] == c.S_PHOTONPID: key = c.S_PHOTONHITS
-
-        # Process photon hits
-        if key == c.S_PHOTONHITS:
-            volid = int(int(event[c.IDBANK][c.S_VOL][hi])/10**8)
-            if volid == c.SENSOR1A_ID or volid == c.SENSOR1B_ID: key = c.S_PHOTONH1
-            if volid == c.SENSOR2A_ID or volid == c.SENSOR2B_ID: key = c.S_PHOTONH2
-
-        if key is None: continue # Ignore uninteresting hits.
-
-        # Add hit to dictionary, converting data to appropiate units.
-        hits[key][c.S_N]   .append(int  (event[c.IDBANK][c.S_HITN]  [hi]))     # hit id.
-        hits[key][c.S_ID]  .append(int  (event[c.IRBANK][c.S_TID]   [hi]))     # track id.
-        hits[key][c.S_PID] .append(int  (event[c.IRBANK][c.S_PID]   [hi]))     # particle id.
-        hits[key][c.S_X]   .append(float(event[c.IRBANK][c.S_AVGX]  [hi])/10.) # x position (cm).
-        hits[key][c.S_Y]   .append(float(event[c.IRBANK][c.S_AVGY]  [hi])/10.) # y position (cm).
-        hits[key][c.S_Z]   .append(float(event[c.IRBANK][c.S_AVGZ]  [hi])/10.) # z position (cm).
-        hits[key][c.S_T]   .append(float(event[c.IRBANK][c.S_AVGT]  [hi]))     # Time (ns).
-        hits[key][c.S_ED]  .append(float(event[c.IRBANK][c.S_EDEP]  [hi]))     # EDep (MeV).
-        hits[key][c.S_TRKE].append(float(event[c.IRBANK][c.S_TRACKE][hi]))     # TrkE (MeV).
+    raw   = event[c.IRBANK]
+    dig   = event[c.IDBANK]
+    nhits = len(dig.get(c.S_HITN, []))
+
+    # Determine hit sources, ignoring hits with no energy deposited. Banks stored as strings are
+    # compared as strings, as they're written in the input file.
+    if isinstance(dig.get(c.S_HITN), numpy.ndarray):
+        pid     = raw[c.S_PID][:nhits]
+        massive = numpy.isin(pid, c.MASSPIDS)
+        photon  = pid == c.PHOTONPID
+        nonzero = raw[c.S_EDEP][:nhits] != 0
+        vol     = dig[c.S_VOL][:nhits]
+    else:
+        pid     = raw.get(c.S_PID, [])[:nhits]
+        massive = numpy.fromiter((p in _S_MASSPIDS for p in pid), bool, nhits)
+        photon  = numpy.fromiter((p == c.S_PHOTONPID for p in pid), bool, nhits)
+        nonzero = numpy.fromiter((e != '0' for e in raw.get(c.S_EDEP, [])[:nhits]), bool, nhits)
+        vol     = numpy.array(dig.get(c.S_VOL, [])[:nhits], dtype=numpy.int64)
+    volid = numpy.trunc(vol/10**8)
+    side1 = numpy.isin(volid, [c.SENSOR1A_ID, c.SENSOR1B_ID])
+    side2 = numpy.isin(volid, [c.SENSOR2A_ID, c.SENSOR2B_ID])
+
+    category = numpy.full(nhits, -1, dtype=numpy.int8)
+    category[massive & nonzero] = HITKEYS.index(c.S_MASSHITS)
+    category[photon & nonzero]  = HITKEYS.index(c.S_PHOTONHITS)
+    category[photon & nonzero & side1] = HITKEYS.index(c.S_PHOTONH1)
+    category[photon & nonzero & side2] = HITKEYS.index(c.S_PHOTONH2)
 
+    # Store hits, converting data to appropiate units.
+    columns = {c.S_N:    dig[c.S_HITN]   [:nhits], # hit id.
+               c.S_ID:   raw[c.S_TID]    [:nhits], # track id.
+               c.S_PID:  raw[c.S_PID]    [:nhits], # particle id.
+               c.S_X:    raw[c.S_AVGX]   [:nhits], # x position (mm).
+               c.S_Y:    raw[c.S_AVGY]   [:nhits], # y position (mm).
+               c.S_Z:    raw[c.S_AVGZ]   [:nhits], # z position (mm).
+               c.S_T:    raw[c.S_AVGT]   [:nhits], # Time (ns).
+               c.S_ED:   raw[c.S_EDEP]   [:nhits], # EDep (MeV).
+               c.S_TRKE: raw[c.S_TRACKE] [:nhits]} if nhits else \
+              {col: numpy.zeros(0) for (col, _) in HITCOLS}
+    hits = EventHits(columns, category)
+    for col in (c.S_X, c.S_Y, c.S_Z): numpy.divide(hits.columns[col], 10., out=hits.columns[col])
     return hits
@@ -8,6 +8,10 @@ Handles interactions with GEMC the file, as in storing metadata and events. Is n
 access to IO.
 """
 
+import re
+
+import numpy
+
 import constants as c
 
 def store_metadata(file):
@@ -44,19 +48,76 @@ def store_metadata(file):
     file.seek(x)
     return metadata
 
-def store_event(file):
+# Returned instead of an event by store_event() and parse_event() when an event filter rejects it.
+FILTERED = object()
+
+# Columns of the raw and digitized banks read by EventFilter.
+_FILTERCOLS = (c.S_PID, c.S_EDEP, c.S_VOL)
+
+class EventFilter:
+    """
+    Decides whether an event should be translated from the text of only three of its columns, so
+    that rejected events are skipped without parsing the rest of them. Only hits with energy
+    deposited are considered, as extract_hits() does, and events are always required to have
+    massive particle hits and photon hits on the endplates, which are needed to translate them.
+    """
+    __slots__ = ("pids", "volumes", "minhits", "minedep")
+
+    def __init__(self, pids=None, volumes=None, minhits=0, minedep=0.):
+        """
+        Set the conditions that accepted events must meet.
+        :param pids:    list of PIDs of which an event needs at least one hit, or None.
+        :param volumes: list of volume IDs in which an event needs at least one hit, or None. Volume
+                        IDs are the first digits of the volume column, as SENSOR1A_ID is.
+        :param minhits: minimum number of hits of an event.
+        :param minedep: minimum energy deposited by all the hits of an event together, in MeV.
+        """
+        self.pids    = pids
+        self.volumes = volumes
+        self.minhits = minhits
+        self.minedep = minedep
+
+    def __repr__(self):
+        return "EventFilter" + repr((self.pids, self.volumes, self.minhits, self.minedep))
+
+    def accepts(self, columns):
+        """
+        Check if an event meets every condition.
+        :param columns: dictionary with the tab-separated values of each column in _FILTERCOLS, as
+                        strings or bytes. Missing columns are taken as empty.
+        :return:        whether the event should be translated.
+        """
+        (pid, edep, vol) = (numpy.fromstring(columns.get(key, ""), dtype=c.TYPEDCOLS[key], sep='\t')
+                            for key in _FILTERCOLS)
+        nhits = min(len(pid), len(edep), len(vol))
+        stored = edep[:nhits] != 0
+        (pid, edep, vol) = (pid[:nhits][stored], edep[:nhits][stored], vol[:nhits][stored])
+        volid  = vol//10**8
+        photon = (pid == c.PHOTONPID) & numpy.isin(volid, [c.SENSOR1A_ID, c.SENSOR1B_ID,
+                                                           c.SENSOR2A_ID, c.SENSOR2B_ID])
+        if not (numpy.isin(pid, c.MASSPIDS).any() and photon.any()): return False
+        if self.pids    is not None and not numpy.isin(pid, self.pids).any():      return False
+        if self.volumes is not None and not numpy.isin(volid, self.volumes).any(): return False
+        return len(pid) >= self.minhits and edep.sum() >= self.minedep
+
+def store_event(file, typed=False, efilter=None):
     """
     Store one event's data as a dictionary of dictionaries, assuming that the metadata has already
     been stored.
-    :param file: input file with metadata (and pesky embedded json) removed.
-    :return:     a dict with 5 dicts whose keys are the 5 BANK constants. Each describes the
-                 following:
-                   * HBANK:  header bank (10).
-                   * UHBANK: user header bank (currently empty). Assumed to have same format as
-                             header bank.
-                   * IRBANK: integrated raw bank (51).
-                   * IDBANK: integrated digitized bank (52).
-                   * GPBANK: generated particles bank.
+    :param file:    input file with metadata (and pesky embedded json) removed.
+    :param typed:   if True, the columns of the raw and digitized banks listed in TYPEDCOLS are
+                    stored as numpy arrays of the listed type instead of lists of strings, and all
+                    other columns of these banks are ignored.
+    :param efilter: EventFilter that the event must pass to be stored, or None. The event's lines
+                    are only split once it passes.
+    :return:        a dict with 5 dicts whose keys are the 5 BANK constants, or FILTERED if the
+                    event was rejected by efilter. Each dict describes the following:
+                      * HBANK:  header bank (10).
+                      * UHBANK: user header bank (currently empty). Assumed to have same format as
+                                header bank.
+                      * IRBANK: integrated raw bank (51).
+                      * IDBANK: integrated digitized bank (52).
+                      * GPBANK: generated particles bank.
     """
     event_data = {
         c.HBANK  : {},
@@ -67,6 +128,8 @@ def store_event(file):
     }
     bank = None
     eof = 0 # End of file checker.
+    lines   = [] # Lines waiting for the event to pass efilter.
+    columns = {}
 
     while True:
         l = file.readline()
@@ -84,25 +147,145 @@ def store_event(file):
         elif l == c.S_IDBANK: bank = c.IDBANK
         elif l == c.S_GPBANK: bank = c.GPBANK
 
-        if bank != c.GPBANK:
-            sl = l.split('\t')
-            if len(sl) == 1: continue # Ignore lines with titles & irrelevant information.
-
-        if bank == c.HBANK or bank == c.UHBANK: # Header & user header banks.
-            event_data[bank][sl[0].split(' ')[-1][:-1]] = sl[1]
-        if bank == c.IRBANK or bank == c.IDBANK: # Raw & Digitized banks.
-            event_data[bank][sl[0].split(' ')[-1][:-1]] = sl[1:]
-        if bank == c.GPBANK: # Generated particles bank.
-            sl = l.split()
-            if sl[1] == c.S_PARTICLE:
-                event_data[bank][sl[ 3][:-1]] = sl[ 4]
-                event_data[bank][sl[ 6][:-1]] = sl[ 7]
-                event_data[bank][sl[10][:-1]] = sl[11]
-            if sl[1] == c.S_HIT:
-                event_data[bank][c.S_NHITS] = sl[ 4]
-                event_data[bank][sl[ 7]]  = sl[ 8]
-                event_data[bank][sl[11]]  = sl[12]
+        if efilter is None:
+            _store_line(event_data, bank, l, typed)
+            continue
+        if bank == c.IRBANK or bank == c.IDBANK:
+            (head, sep, values) = l.partition('\t')
+            if sep and head.split(' ')[-1][:-1] in _FILTERCOLS:
+                columns[head.split(' ')[-1][:-1]] = values
+        lines.append((bank, l))
     if eof != 0:
         return None
 
+    if efilter is not None:
+        if not efilter.accepts(columns): return FILTERED
+        for (bank, l) in lines: _store_line(event_data, bank, l, typed)
     return event_data
+
+def _store_line(event_data, bank, l, typed):
+    """Store one line of an event, stripped of trailing whitespace, in the given bank.
+    """
+    if typed and (bank == c.IRBANK or bank == c.IDBANK): # Typed raw & digitized banks.
+        (head, sep, values) = l.partition('\t')
+        if not sep: return
+        key = head.split(' ')[-1][:-1]
+        if key in c.TYPEDCOLS:
+            event_data[bank][key] = numpy.fromstring(values, dtype=c.TYPEDCOLS[key], sep='\t')
+        return
+
+    if bank != c.GPBANK:
+        sl = l.split('\t')
+        if len(sl) == 1: return # Ignore lines with titles & irrelevant information.
+
+    if bank == c.HBANK or bank == c.UHBANK: # Header & user header banks.
+        event_data[bank][sl[0].split(' ')[-1][:-1]] = sl[1]
+    if bank == c.IRBANK or bank == c.IDBANK: # Raw & Digitized banks.
+        event_data[bank][sl[0].split(' ')[-1][:-1]] = sl[1:]
+    if bank == c.GPBANK: # Generated particles bank.
+        sl = l.split()
+        if sl[1] == c.S_PARTICLE:
+            event_data[bank][sl[ 3][:-1]] = sl[ 4]
+            event_data[bank][sl[ 6][:-1]] = sl[ 7]
+            event_data[bank][sl[10][:-1]] = sl[11]
+        if sl[1] == c.S_HIT:
+            event_data[bank][c.S_NHITS] = sl[ 4]
+            event_data[bank][sl[ 7]]  = sl[ 8]
+            event_data[bank][sl[11]]  = sl[12]
+
+# Bank headers and end of event marker, for parse_event().
+_S_BANKS = {c.S_HBANK: c.HBANK, c.S_UHBANK: c.UHBANK, c.S_IRBANK: c.IRBANK, c.S_IDBANK: c.IDBANK,
+            c.S_GPBANK: c.GPBANK}
+_B_BANKS = {c.S_HBANK.encode(): c.HBANK, c.S_UHBANK.encode(): c.UHBANK,
+            c.S_IRBANK.encode(): c.IRBANK, c.S_IDBANK.encode(): c.IDBANK,
+            c.S_GPBANK.encode(): c.GPBANK}
+_B_EOE = b"\n" + c.S_EOE.encode()
+_B_TYPEDCOLS = {key.encode(): (key, dtype) for (key, dtype) in c.TYPEDCOLS.items()}
+_B_EMPTYLINE  = re.compile(rb"\n[ \t\r\v\f]*\n")
+_B_FILTERCOLS = [(key, b"\n" + bank.encode(), b" " + key.encode() + b":\t")
+                 for (key, bank) in ((c.S_PID, c.S_IRBANK), (c.S_EDEP, c.S_IRBANK),
+                                     (c.S_VOL, c.S_IDBANK))]
+
+def parse_event(buf, pos, typed=False, efilter=None):
+    """
+    Store one event's data from a buffer of bytes, such as a memory-mapped file. Finds the end of
+    the event with a single byte search instead of reading it line by line, and when typed, converts
+    the columns in TYPEDCOLS directly from bytes without decoding the rest of the raw and digitized
+    banks. Applies the same stopping conditions as store_event().
+    :param buf:   bytes-like object with the contents of the input file.
+    :param pos:   position in buf where the event starts, after the metadata and previous events.
+    :param typed:   whether to store the raw and digitized banks as typed arrays, as described in
+                    the store_event() method.
+    :param efilter: EventFilter that the event must pass to be stored, or None. Its columns are
+                    found with byte searches, and rejected events aren't decoded at all.
+    :return:        a 2-tuple with the event (0) in the format defined by the store_event() method,
+                    None if the end of file was reached, or FILTERED if the event was rejected by
+                    efilter, and the position where the next event starts (1).
+    """
+    # Find the end of event marker, which must be followed only by whitespace in its line.
+    start = max(pos-1, 0)
+    while True:
+        end = buf.find(_B_EOE, start)
+        if end < 0: return (None, len(buf))
+        nxt = buf.find(b"\n", end+1)
+        if nxt < 0: nxt = len(buf)
+        if not buf[end+len(_B_EOE):nxt].strip(): break
+        start = end+1
+    # Skip rejected events without decoding them, unless an empty line inside them ends the file.
+    if efilter is not None and end >= pos and not efilter.accepts(_find_columns(buf, pos, end)):
+        if not _B_EMPTYLINE.search(buf, max(pos-1, 0), end+1): return (FILTERED, nxt+1)
+    # Decode the entire event at once, unless only some of its columns need to be decoded.
+    lines = []
+    if end >= pos: lines = buf[pos:end].split(b"\n") if typed else buf[pos:end].decode().split("\n")
+    banks = _B_BANKS if typed else _S_BANKS
+
+    event_data = {
+        c.HBANK  : {},
+        c.UHBANK : {},
+        c.IRBANK : {},
+        c.IDBANK : {},
+        c.GPBANK : {},
+    }
+    bank = None
+    for l in lines:
+        l = l.rstrip()
+        if not l: return (None, len(buf)) # An empty line is treated as the end of file.
+        bank = banks.get(l, bank)
+
+        if typed and (bank == c.IRBANK or bank == c.IDBANK): # Typed raw & digitized banks.
+            (head, sep, values) = l.partition(b"\t")
+            if not sep: continue
+            col = _B_TYPEDCOLS.get(head.split(b" ")[-1][:-1])
+            if col is not None:
+                event_data[bank][col[0]] = numpy.fromstring(values, dtype=col[1], sep='\t')
+            continue
+        _store_line(event_data, bank, l.decode() if typed else l, typed)
+    return (event_data, nxt+1)
+
+def _find_columns(buf, pos, end):
+    """Find the values of the columns read by EventFilter in an event stored in buf[pos:end].
+    """
+    columns = {}
+    for (key, bank, head) in _B_FILTERCOLS:
+        start = buf.find(bank, pos, end)
+        if start < 0: continue
+        start = buf.find(head, start, end)
+        if start < 0: continue
+        start += len(head)
+        stop   = buf.find(b"\n", start, end)
+        columns[key] = buf[start:stop if stop >= 0 else end].rstrip()
+    return columns
+
+def iter_events(file, typed=False):
+    """
+    Yield each of the remaining events in a file, assuming that the metadata has already been
+    stored.
+    :param file:  input file with metadata (and pesky embedded json) removed.
+    :param typed: whether to store the raw and digitized banks as typed arrays, as described in the
+                  store_event() method.
+    :return:      a generator of events in the format defined by the store_event() method.
+    """
+    while True:
+        event = store_event(file, typed)
+        if not event: return # Reached end of file.
+        yield event
@@ -7,18 +7,43 @@
 Handles gruid events. Generates gruid events with matrix time series for a set of GEMC hits.
 """
 
-import copy
+import atexit
 import math
+import multiprocessing
 import numpy # NOTE: We could do without numpy...
-import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 from operator import itemgetter
 
 import constants as c
+import stats
 
-def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz):
+# Columns of the sparse arrays generated by generate_arrays() for each section, with their types.
+SIDE_COLUMNS  = [(c.S_TSTEP, numpy.int32), (c.S_X, numpy.int32), (c.S_Y, numpy.int32),
+                 (c.S_GRUIDNHITS, numpy.int32), (c.S_GRUIDEDEP, numpy.float64)]
+BODY_COLUMNS  = [(c.S_TSTEP, numpy.int32), (c.S_X, numpy.int32), (c.S_Y, numpy.int32),
+                 (c.S_Z, numpy.int32), (c.S_PID, numpy.int32), (c.S_ED, numpy.float64)]
+AGG_COLUMNS   = [(c.S_TSTEP, numpy.int32), (c.S_X, numpy.int32), (c.S_Y, numpy.int32),
+                 (c.S_Z, numpy.int32), (c.S_PID, numpy.int32), (c.S_GRUIDNHITS, numpy.int32),
+                 (c.S_GRUIDEDEP, numpy.float64)]
+PLANE_COLUMNS = [(c.S_TSTEP, numpy.int32), (c.S_TID, numpy.int64), (c.S_TRKE, numpy.float64),
+                 (c.S_T, numpy.float64), (c.S_PID, numpy.int32)]
+
+# Number of processes and minimum number of hits of the events split by generate_event(), as set by
+# split_events(), and pool of processes used to split them, started by the first event split in
+# each process and shut down by close_split().
+_splitworkers = 1
+_splithits    = 0
+_splitpool    = None
+_splitpid     = None
+
+def _gen_ts_ref(hits, deltax, deltay, deltaz, dt, dx, dy, dz, aggregate=False):
     """
     Generates a time series of sparse 2-dimensional or 3-dimensional matrices from a list of hits.
-    :param hits:      list of hits in the output format of the extract_hits() method.
+    Reference implementation, stepping through every time step and bin edge for each hit. Kept to
+    validate _gen_ts(), which produces the exact same output.
+    :param hits:      dictionary of hit columns, as stored for each category by extract_hits().
     :param deltax:    how much the entire detector is shifted from the x axis. Used to obtain the
                       size of the generated matrices.
     :param deltay:    how much the entire detector is shifted from the y axis. Used to obtain the
@@ -32,13 +57,17 @@ def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz):
                       detector.
     :param dz:        size of the matrices' depth columns. Doesn't need to divide the total z size
                       of the detector. If this is NaN, no depth processing is done.
+    :param aggregate: whether to store the number of hits and energy deposited by each PID in each
+                      cell of a 3-dimensional time series, as described in _aggregate_cell(),
+                      instead of a list with the PID and energy deposited of each hit.
     :return:          a dictionary of 2-dimensional sparse matrices. Each matrix is defined as a
                       dictionary where a key is a tuple describing position and a value is the
                       energy deposited in eV. To further reduce storage use, if not hits are found
                       for a specific t, that t isn't event stored in the time series.
     """
     if not hits: return None
-    chits = copy.deepcopy(hits) # Deep copy hits to avoid damaging original dictionary.
+    chits  = _lists(hits)
+    stored = [False]*len(chits[c.S_N]) # Hits already stored, which aren't checked again.
 
     tseries = {}
     max_t = 0.
@@ -51,6 +80,7 @@ def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz):
 
         for hi in range(len(chits[c.S_N])-1, -1, -1):
             # Check if hit is in dt.
+            if stored[hi]: continue
             if t > chits[c.S_T][hi] or t+dt <= chits[c.S_T][hi]: continue
 
             # Store hit's position.
@@ -71,9 +101,8 @@ def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz):
                 #       respectively and a hit happens exactly at an edge... kaboom, a hit is lost.
                 #       The probability of this happening on a 64-bit computer is pretty low, so I
                 #       don't think adding the extra computing time and error checking is worth it.
-                print("ERROR: Either something is deeply wrong in the input data, or nrows and/or" \
-                      " ncols is set wrong. It's probably the latter.", file=sys.stderr)
-                exit()
+                raise ValueError("Either something is deeply wrong in the input data, or nrows "
+                                 "and/or ncols is set wrong. It's probably the latter.")
 
             ok = str(int((deltax+sx)/dx)) + ',' + str(int((deltay+sy)/dy))
             if not math.isnan(dz):
@@ -86,16 +115,378 @@ def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz):
                 phits[ok][c.S_GRUIDNHITS] += 1
                 phits[ok][c.S_GRUIDEDEP]  += chits[c.S_ED][hi]
 
-            for ikey in chits.keys(): chits[ikey].pop(hi)
-            hitstored = True
+            stored[hi] = True
+            hitstored  = True
 
         if hitstored: tseries[t] = phits
+
+    if aggregate and not math.isnan(dz):
+        for phits in tseries.values():
+            for (ok, hitlist) in phits.items(): phits[ok] = _aggregate_cell(hitlist)
     return tseries
 
-def _gen_pd(hits, dt, vx, vy, vz, nx, ny, nz):
+def _aggregate_cell(hitlist):
+    """
+    Aggregate the hits of a cell of a 3-dimensional time series by PID.
+    :param hitlist: list of 2-tuples with the PID (0) and energy deposited (1) of each hit.
+    :return:        a dictionary with a list of the PIDs in the cell, in the order in which they
+                    first appear in hitlist (S_PID), and for each of these the number of hits
+                    (S_GRUIDNHITS) and the energy deposited by them (S_GRUIDEDEP).
+    """
+    cell = {c.S_PID: [], c.S_GRUIDNHITS: [], c.S_GRUIDEDEP: []}
+    for (pid, edep) in hitlist:
+        if pid not in cell[c.S_PID]:
+            cell[c.S_PID].append(pid)
+            cell[c.S_GRUIDNHITS].append(0)
+            cell[c.S_GRUIDEDEP].append(0.)
+        pi = cell[c.S_PID].index(pid)
+        cell[c.S_GRUIDNHITS][pi] += 1
+        cell[c.S_GRUIDEDEP][pi]  += edep
+    return cell
+
+def _lists(hits):
+    """Get hit columns as lists of python numbers, as used by the reference implementations.
+    """
+    return {key: numpy.asarray(col).tolist() for (key, col) in hits.items()}
+
+def _bin(edges, width, vals, first=False):
+    """
+    Find the bin [edge, edge+width) in which each value falls, replicating the comparisons done in
+    _gen_ts_ref().
+    :param edges: sorted array with the lower edge of each bin.
+    :param width: width of each bin.
+    :param vals:  array of values to be binned.
+    :param first: if True, pick the first matching bin instead of the last one. This only makes a
+                  difference when floating point errors make two consecutive bins overlap.
+    :return:      array with the index of each value's bin, or -1 if it falls outside all bins.
+    """
+    if edges.size == 0: return numpy.full(vals.shape, -1)
+    idx = numpy.searchsorted(edges, vals, side='right') - 1
+    bi  = numpy.where((idx >= 0) & (vals < edges[idx.clip(0)] + width), idx, -1)
+    if first:
+        prev = idx - 1
+        bi   = numpy.where((prev >= 0) & (vals < edges[prev.clip(0)] + width), prev, bi)
+    return bi
+
+def _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz, aggregate=False, tmax=None):
+    """
+    Generates a time series of sparse 2-dimensional or 3-dimensional matrices from a list of hits.
+    Computes the time and position bins of all hits at once and aggregates them by cell, instead of
+    looping through every time step and bin edge as _gen_ts_ref() does. Parameters and output are
+    the same as _gen_ts_ref()'s, including the order in which the time series' keys are inserted,
+    except for tmax, which is described in _group_hits().
+    """
+    if not hits: return None
+
+    tseries = {}
+    grouped = _group_hits(hits, deltax, deltay, deltaz, dt, dx, dy, dz, tmax)
+    if grouped is None: return tseries
+    (tarr, order, ti, cells, first, inverse, gorder) = grouped
+    names   = [ni.astype(str).tolist() for ni in cells]
+    ngroups = first.size
+    gorder  = gorder.tolist()
+
+    # Aggregate hits in each group.
+    if not math.isnan(dz) and aggregate:
+        pids   = numpy.asarray(hits[c.S_PID])[order]
+        (pfirst, pinverse) = _group_pids(pids, inverse)
+        nhits  = numpy.bincount(pinverse).tolist()
+        edeps  = numpy.bincount(pinverse,
+                                weights=numpy.asarray(hits[c.S_ED], dtype=float)[order]).tolist()
+        pgroups = inverse[pfirst].tolist()
+        ppids   = pids[pfirst].tolist()
+        values  = [{c.S_PID: [], c.S_GRUIDNHITS: [], c.S_GRUIDEDEP: []} for _ in range(ngroups)]
+        # Sorting pairs by their first hit sorts the PIDs of each group by first appearance.
+        for pi in numpy.argsort(pfirst).tolist():
+            value = values[pgroups[pi]]
+            value[c.S_PID].append(ppids[pi])
+            value[c.S_GRUIDNHITS].append(nhits[pi])
+            value[c.S_GRUIDEDEP].append(edeps[pi])
+    elif not math.isnan(dz):
+        pids   = numpy.asarray(hits[c.S_PID])[order].tolist()
+        edeps  = numpy.asarray(hits[c.S_ED], dtype=float)[order].tolist()
+        perm   = numpy.argsort(inverse, kind='stable').tolist()
+        bounds = numpy.cumsum(numpy.bincount(inverse, minlength=ngroups)).tolist()
+        values = [[(pids[hi], edeps[hi]) for hi in perm[b0:b1]]
+                  for (b0, b1) in zip([0] + bounds[:-1], bounds)]
+    else:
+        nhits  = numpy.bincount(inverse, minlength=ngroups).tolist()
+        edeps  = numpy.bincount(inverse, minlength=ngroups,
+                                weights=numpy.asarray(hits[c.S_ED], dtype=float)[order]).tolist()
+        values = [{c.S_GRUIDNHITS: n, c.S_GRUIDEDEP: e} for (n, e) in zip(nhits, edeps)]
+
+    # Build the sparse matrices.
+    tkeys = ti[first].tolist()
+    first = first.tolist()
+    for gi in gorder:
+        t = tarr[tkeys[gi]]
+        if t not in tseries: tseries[t] = {}
+        tseries[t][','.join(n[first[gi]] for n in names)] = values[gi]
+    return tseries
+
+def _gen_ts_coo(hits, deltax, deltay, deltaz, dt, dx, dy, dz, aggregate=False):
+    """
+    Generates the same time series as _gen_ts(), but as sparse arrays in coordinate format instead
+    of dictionaries, without building any intermediate python objects. Parameters are the same as
+    _gen_ts_ref()'s.
+    :return: a dictionary with an array per column in SIDE_COLUMNS, with one entry per cell, or in
+             BODY_COLUMNS if dz isn't NaN, with one entry per hit, or in AGG_COLUMNS if aggregate
+             is also set, with one entry per PID in each cell. Entries are in the same order as
+             the cells and hits of _gen_ts()'s output, and time steps are the index of each instant
+             of time in the series, so that t = S_TSTEP*dt.
+    """
+    depth   = not math.isnan(dz)
+    columns = (AGG_COLUMNS if aggregate else BODY_COLUMNS) if depth else SIDE_COLUMNS
+    grouped = _group_hits(hits, deltax, deltay, deltaz, dt, dx, dy, dz)
+    if grouped is None: return {name: numpy.zeros(0, dtype=dtype) for (name, dtype) in columns}
+    (tarr, order, ti, cells, first, inverse, gorder) = grouped
+
+    if depth and aggregate:
+        # One entry per PID in each group, sorted by group and then by first appearance.
+        rank = numpy.empty_like(gorder)
+        rank[gorder] = numpy.arange(gorder.size)
+        pids = numpy.asarray(hits[c.S_PID])[order]
+        (pfirst, pinverse) = _group_pids(pids, inverse)
+        prows = numpy.lexsort((pfirst, rank[inverse[pfirst]]))
+        rows  = pfirst[prows]
+        cols  = [ti[rows]] + [ni[rows] for ni in cells] + \
+                [pids[rows], numpy.bincount(pinverse)[prows],
+                 numpy.bincount(pinverse,
+                                weights=numpy.asarray(hits[c.S_ED], dtype=float)[order])[prows]]
+    elif depth:
+        # One entry per hit, sorted by group and then by the order in which _gen_ts() lists them.
+        rank = numpy.empty_like(gorder)
+        rank[gorder] = numpy.arange(gorder.size)
+        rows = numpy.lexsort((numpy.arange(order.size), rank[inverse]))
+        cols = [ti[rows]] + [ni[rows] for ni in cells] + \
+               [numpy.asarray(hits[c.S_PID])[order][rows],
+                numpy.asarray(hits[c.S_ED], dtype=float)[order][rows]]
+    else:
+        ngroups = first.size
+        gfirst  = first[gorder]
+        cols    = [ti[gfirst]] + [ni[gfirst] for ni in cells] + \
+                  [numpy.bincount(inverse, minlength=ngroups)[gorder],
+                   numpy.bincount(inverse, minlength=ngroups,
+                                  weights=numpy.asarray(hits[c.S_ED], dtype=float)[order])[gorder]]
+    return {name: col.astype(dtype) for ((name, dtype), col) in zip(columns, cols)}
+
+def _group_hits(hits, deltax, deltay, deltaz, dt, dx, dy, dz, tmax=None):
+    """
+    Find the time step and cell of each hit, and group hits by both. Parameters are the same as
+    _gen_ts_ref()'s, except for tmax, the time up to which time steps are generated, which is the
+    time of the last hit if None. It's given when hits are only part of the time series' hits.
+    :return: None if no hit falls in a time step, or a 7-tuple with the lower edge of each time step
+             (0), the indices of the hits that do in the order they're processed (1), and for each
+             of these the index of its time step (2) and a list with the index of its cell in each
+             axis (3), followed by the first hit of each group (4), the group of each hit (5), and
+             the order in which groups are stored (6), sorted by time step and first appearance.
+    """
+    ht = numpy.asarray(hits[c.S_T], dtype=float)
+    if ht.size == 0: return None
+
+    # Find the time step of each hit. Hits outside of all time steps are ignored.
+    if tmax is None: tmax = numpy.fmax.reduce(ht, initial=0.)
+    tarr = numpy.arange(0., tmax, dt)
+    ti   = _bin(tarr, dt, ht, first=True)
+
+    # _gen_ts_ref() processes hits from last to first, so we do the same to keep the same order.
+    order = numpy.flatnonzero(ti >= 0)[::-1]
+    if order.size == 0: return None
+    ti = ti[order]
+
+    # Find the position bin of each hit, numbered as _gen_ts_ref() names them.
+    axes  = [(deltax, dx, c.S_X), (deltay, dy, c.S_Y)]
+    if not math.isnan(dz): axes.append((deltaz, dz, c.S_Z))
+    cells = numpy.zeros(order.size, dtype=numpy.int64)
+    ncell = 1
+    nis   = []
+    for (delta, d, key) in axes:
+        edges = numpy.arange(-delta, delta+d, d)
+        bi    = _bin(edges, d, numpy.asarray(hits[key], dtype=float)[order])
+        if (bi < 0).any():
+            raise ValueError("Either something is deeply wrong in the input data, or nrows "
+                             "and/or ncols is set wrong. It's probably the latter.")
+        # NOTE: Due to floating point errors two neighbouring bins might share the same name, in
+        #       which case _gen_ts_ref() merges them. Cells are defined by name to do the same.
+        ni     = ((delta+edges)/d).astype(int)[bi]
+        cells  = cells*(ni.max()+1) + ni
+        ncell *= ni.max()+1
+        nis.append(ni)
+
+    # Group hits by time step and cell, sorting groups by time step and then by first appearance.
+    (groups, first, inverse) = numpy.unique(ti*ncell + cells, return_index=True,
+                                            return_inverse=True)
+    gorder = numpy.lexsort((first, ti[first]))
+    return (tarr, order, ti, nis, first, inverse.reshape(-1), gorder)
+
+def _group_pids(pids, inverse):
+    """
+    Group the hits of each group returned by _group_hits() by PID.
+    :param pids:    PID of each hit, in the order in which they're processed.
+    :param inverse: group of each hit, as returned by _group_hits().
+    :return:        a 2-tuple with the first hit of each pair of group and PID (0), and the pair of
+                    each hit (1).
+    """
+    (_, pcodes) = numpy.unique(pids, return_inverse=True)
+    pcodes = pcodes.reshape(-1)
+    (_, first, pairs) = numpy.unique(inverse*(pcodes.max()+1) + pcodes, return_index=True,
+                                     return_inverse=True)
+    return (first, pairs.reshape(-1))
+
+def split_events(workers, threshold):
+    """
+    Have generate_event() split events with at least threshold hits between a pool of processes,
+    generating their sections at the same time instead of one after another. Only used with
+    ENGINE_VEC.
+    :param workers:   number of processes of the pool.
+    :param threshold: minimum number of hits of the events that are split. Time series with at
+                      least this many hits are also split in ranges of time steps.
+    """
+    global _splitworkers, _splithits
+    (_splitworkers, _splithits) = (workers, threshold)
+
+def _split_pool():
+    """Get the pool of processes used to split events, starting one if this process has none.
+    """
+    global _splitpool, _splitpid
+    if _splitpid != os.getpid():
+        # Processes are spawned instead of forked, since events may be translated outside of the
+        # main thread.
+        _splitpool = ProcessPoolExecutor(_splitworkers, multiprocessing.get_context("spawn"),
+                                         _init_split_worker)
+        _splitpid  = os.getpid()
+        atexit.register(close_split)
+    return _splitpool
+
+def close_split():
+    """Shut down the pool of processes used to split events, if this process started one.
+    """
+    global _splitpool, _splitpid
+    if _splitpid == os.getpid(): _splitpool.shutdown()
+    (_splitpool, _splitpid) = (None, None)
+
+def _init_split_worker():
+    """
+    Keep a process of the pool set by split_events() from tracking the shared memory it attaches
+    to, which would otherwise be released or reported as leaked when the process exits. Blocks are
+    only tracked and released by the process that creates them, in _generate_split().
+    """
+    register = resource_tracker.register
+    def register_untracked(name, rtype):
+        if rtype != "shared_memory": register(name, rtype)
+    resource_tracker.register = register_untracked
+
+def _generate_split(hits, sarr, deltax, deltay, dt, dx, dy, dz, aggregate=False, plane=None):
+    """
+    Generate sections of an event at the same time in the pool of processes set by split_events(),
+    storing the event's hits in shared memory so that they aren't copied to each process. Time
+    series with enough hits are split in ranges of time steps with about the same number of hits,
+    which are merged back in order. Output is the same as generating each section by itself.
+    :param hits:      hits of the event, as returned by extract_hits().
+    :param sarr:      list of 2-tuples with the name of each time series and the category of hits
+                      it's generated from, as returned by _prepare_event().
+    :param deltax:    how much the entire detector is shifted from the x axis.
+    :param deltay:    how much the entire detector is shifted from the y axis.
+    :param dt:        delta t for the time series.
+    :param dx:        size of the matrices' columns.
+    :param dy:        size of the matrices' rows.
+    :param dz:        size of the body's matrices' depth columns.
+    :param aggregate: whether to aggregate the hits of each cell of the body's time series by PID.
+    :param plane:     6-tuple with the vertex (0-2) and normal vector (3-5) of the detecting plane,
+                      or None if it isn't generated.
+    :return:          a dictionary with each section generated, as generate_event() stores them.
+    """
+    pool   = _split_pool()
+    size   = sum(arr.nbytes for arr in hits.columns.values())
+    shm    = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    layout = []
+    try:
+        offset = 0
+        for (col, arr) in hits.columns.items():
+            numpy.ndarray(arr.shape, arr.dtype, shm.buf, offset)[:] = arr
+            layout.append((col, arr.dtype.str, arr.size, offset))
+            offset += arr.nbytes
+
+        parts = {}
+        for (section, key) in sarr:
+            sdz  = dz if section == c.S_GRUIDHB else float("nan")
+            args = (deltax, deltay, c.DZ, dt, dx, dy, sdz, aggregate)
+            (tmax, ranges) = _split_steps(hits[key][c.S_T], dt)
+            parts[section] = [pool.submit(_generate_part, shm.name, layout, hits.span(key),
+                                          _gen_ts_part, args + (tmax, steps)) for steps in ranges]
+        if plane is not None:
+            parts[c.S_DPLANE] = [pool.submit(_generate_part, shm.name, layout,
+                                             hits.span(c.S_DPLANE), _gen_pd, (dt,) + plane)]
+
+        # Time steps of each range come after the ones of the previous range.
+        event = {}
+        for (section, futures) in parts.items():
+            event[section] = {}
+            for future in futures: event[section].update(future.result())
+        return event
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _split_steps(times, dt):
+    """
+    Split the time steps of a time series in ranges with about the same number of hits, one for
+    each process set by split_events(), if there are at least as many hits as its threshold.
+    :param times: time of each hit of the time series.
+    :param dt:    delta t for the time series.
+    :return:      a 2-tuple with the time up to which time steps are generated (0), as described in
+                  _group_hits(), and a list with the first and last+1 time step of each range (1),
+                  or with None if the time series isn't split.
+    """
+    ht   = numpy.asarray(times, dtype=float)
+    tmax = numpy.fmax.reduce(ht, initial=0.)
+    if ht.size < _splithits or _splitworkers < 2: return (tmax, [None])
+    tarr = numpy.arange(0., tmax, dt)
+    ti   = _bin(tarr, dt, ht, first=True)
+    hcum = numpy.cumsum(numpy.bincount(ti[ti >= 0], minlength=tarr.size))
+    if tarr.size == 0 or hcum[-1] == 0: return (tmax, [None])
+    cuts = numpy.searchsorted(hcum, numpy.arange(1, _splitworkers)*hcum[-1]/_splitworkers) + 1
+    bounds = numpy.unique(numpy.concatenate(([0], cuts.clip(0, tarr.size), [tarr.size]))).tolist()
+    return (tmax, list(zip(bounds[:-1], bounds[1:])))
+
+def _gen_ts_part(hits, deltax, deltay, deltaz, dt, dx, dy, dz, aggregate, tmax, steps):
+    """
+    Generate the part of a time series with the time steps in a range, as returned by
+    _split_steps(), or the whole time series if steps is None. Other parameters are the same as
+    _gen_ts()'s.
+    """
+    if steps is not None:
+        ti   = _bin(numpy.arange(0., tmax, dt), dt, numpy.asarray(hits[c.S_T], dtype=float),
+                    first=True)
+        sel  = numpy.flatnonzero((ti >= steps[0]) & (ti < steps[1]))
+        hits = {col: arr[sel] for (col, arr) in hits.items()}
+    return _gen_ts(hits, deltax, deltay, deltaz, dt, dx, dy, dz, aggregate, tmax)
+
+def _generate_part(name, layout, span, func, args):
+    """
+    Call func with the columns of a category of hits stored in shared memory by _generate_split(),
+    followed by args, in a process of the pool set by split_events().
+    :param name:   name of the shared memory block.
+    :param layout: list of 4-tuples with the name (0), type (1), size (2) and offset in the block
+                   (3) of each column.
+    :param span:   first and last+1 positions of the category's hits in each column.
+    :return:       the value returned by func.
+    """
+    shm  = shared_memory.SharedMemory(name=name)
+    hits = {col: numpy.ndarray(size, dtype, shm.buf, offset)[span[0]:span[1]]
+            for (col, dtype, size, offset) in layout}
+    try:
+        return func(hits, *args)
+    finally:
+        hits.clear() # Views of the block have to be released before closing it.
+        shm.close()
+
+def _gen_pd_ref(hits, dt, vx, vy, vz, nx, ny, nz):
     """
     Generate list of massive particles passing through a plane.
-    :param hits: list of hits in the output format of the extract_hits() method.
+    Reference implementation, grouping hits by track with dictionaries and testing each segment one
+    by one. Kept to validate _gen_pd().
+    :param hits: dictionary of hit columns, as stored for each category by extract_hits().
     :param vx:   x position for the vertex of the detecting plane.
     :param vy:   y position for the vertex of the detecting plane.
     :param vz:   z position for the vertex of the detecting plane.
@@ -104,7 +495,7 @@ def _gen_pd(hits, dt, vx, vy, vz, nx, ny, nz):
     :param nz:   z direction for the vector of the detecting plane.
     """
     if not hits: return None
-    chits = copy.deepcopy(hits) # Deep copy hits to avoid damaging original dictionary.
+    chits = _lists(hits)
 
     # Prepare time series.
     tseries = {}
@@ -133,8 +524,7 @@ def _gen_pd(hits, dt, vx, vy, vz, nx, ny, nz):
     # Normalize the detecting plane's vector direction just in case.
     n = nx**2 + ny**2 + nz**2
     if n == 0:
-        print("ERROR: normal vector is 0! Exiting...", file=sys.stderr)
-        exit()
+        raise ValueError("normal vector is 0!")
     if 0.99 > n or n > 1.01:
         nx /= n
         ny /= n
@@ -175,10 +565,113 @@ def _add_trk(trklist, max_t, dt, htid, hE, ht, hpid):
             trklist[t][c.S_T]   .append(ht)
             trklist[t][c.S_PID] .append(hpid)
 
-def generate_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz):
+def _gen_pd(hits, dt, vx, vy, vz, nx, ny, nz):
+    """
+    Generate list of massive particles passing through a plane.
+    Groups tracks with a single sort and tests all segments at once, finding the time step of each
+    crossing by index arithmetic. Parameters and output are the same as _gen_pd_ref()'s, except that
+    segments parallel to the plane are skipped instead of raising a ZeroDivisionError.
+    """
+    if not hits: return None
+
+    tseries = {}
+    crossings = _cross_plane(hits, dt, vx, vy, vz, nx, ny, nz)
+    if crossings is None: return tseries
+    (tarr, bins, cols) = crossings
+
+    # Build the time series.
+    cols = {key: col.tolist() for (key, col) in cols.items()}
+    (ubins, bstart) = numpy.unique(bins, return_index=True)
+    bounds = bstart.tolist() + [bins.size]
+    for (bi, b0, b1) in zip(ubins.tolist(), bounds[:-1], bounds[1:]):
+        tseries[tarr[bi]] = {key: col[b0:b1] for (key, col) in cols.items()}
+    return tseries
+
+def _gen_pd_coo(hits, dt, vx, vy, vz, nx, ny, nz):
+    """
+    Generate the same list of massive particles passing through a plane as _gen_pd(), but as sparse
+    arrays instead of a time series of dictionaries. Parameters are the same as _gen_pd_ref()'s.
+    :return: a dictionary with an array per column in PLANE_COLUMNS, with one entry per crossing in
+             the same order as in _gen_pd()'s output, and time steps stored as in _gen_ts_coo().
+    """
+    crossings = _cross_plane(hits, dt, vx, vy, vz, nx, ny, nz)
+    if crossings is None: return {name: numpy.zeros(0, dtype=dtype)
+                                  for (name, dtype) in PLANE_COLUMNS}
+    (tarr, bins, cols) = crossings
+    cols[c.S_TSTEP] = bins
+    return {name: cols[name].astype(dtype) for (name, dtype) in PLANE_COLUMNS}
+
+def _cross_plane(hits, dt, vx, vy, vz, nx, ny, nz):
+    """
+    Find the track segments crossing through a plane, and the time step of each crossing.
+    Parameters are the same as _gen_pd_ref()'s.
+    :return: None if there are no time steps or less than two hits, or a 3-tuple with the lower edge
+             of each time step (0), the time step of each crossing (1), and a dictionary with the
+             S_TID, S_TRKE, S_T and S_PID columns of each crossing (2), all sorted by time step.
+    """
+    # Normalize the detecting plane's vector direction just in case.
+    n = nx**2 + ny**2 + nz**2
+    if n == 0:
+        raise ValueError("normal vector is 0!")
+    if 0.99 > n or n > 1.01:
+        nx /= n
+        ny /= n
+        nz /= n
+
+    ht = numpy.asarray(hits[c.S_T], dtype=float)
+    if ht.size < 2: return None
+    tarr = numpy.arange(0., numpy.fmax.reduce(ht, initial=0.), dt)
+
+    # Sort hits by track and time. _gen_pd_ref() loops through hits from last to first and tracks in
+    # order of appearance, so we do the same to keep the same order.
+    rev  = numpy.arange(ht.size-1, -1, -1)
+    (_, ufirst, utrk) = numpy.unique(numpy.asarray(hits[c.S_TID])[rev], return_index=True,
+                                     return_inverse=True)
+    rank  = numpy.argsort(numpy.argsort(ufirst))[utrk.reshape(-1)]
+    order = numpy.lexsort((numpy.arange(ht.size), ht[rev], rank))
+    (sidx, srank) = (rev[order], rank[order])
+
+    # Find segments crossing through the plane.
+    same = srank[:-1] == srank[1:]
+    h0   = sidx[:-1][same]
+    h1   = sidx[1:][same]
+    (x, y, z) = (numpy.asarray(hits[key], dtype=float) for key in (c.S_X, c.S_Y, c.S_Z))
+    pdis  = nx*(vx-x[h0]) + ny*(vy-y[h0]) + nz*(vz-z[h0])
+    alpha = nx*(x[h1]-x[h0]) + ny*(y[h1]-y[h0]) + nz*(z[h1]-z[h0])
+    onplane = (-0.001 < alpha) & (alpha < 0.001) & (-0.001 < pdis) & (pdis < 0.001)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rho   = numpy.abs(pdis/alpha)
+        cross = onplane | ((0 <= rho) & (rho <= 1))
+        (h0, h1, rho, onplane) = (h0[cross], h1[cross], rho[cross], onplane[cross])
+        ct = numpy.where(onplane, ht[h0], (1-rho)*ht[h0] + rho*ht[h1])
+
+    # Find the time steps of each crossing. As in _add_trk(), floating point errors might make a
+    # crossing fall in two time steps, or in none.
+    if tarr.size == 0: return None
+    last  = numpy.searchsorted(tarr, ct, side='left') - 1
+    bins  = []
+    cidxs = []
+    for ti in (last-1, last):
+        ok = (ti >= 0) & (ct < tarr[ti.clip(0)] + dt)
+        bins.append(ti[ok])
+        cidxs.append(numpy.flatnonzero(ok))
+    bins   = numpy.concatenate(bins)
+    cidxs  = numpy.concatenate(cidxs)
+    border = numpy.lexsort((cidxs, bins))
+    (bins, cidxs) = (bins[border], cidxs[border])
+
+    cols = {c.S_TID:  numpy.asarray(hits[c.S_TID])[h0][cidxs],
+            c.S_TRKE: numpy.asarray(hits[c.S_TRKE], dtype=float)[h0][cidxs],
+            c.S_T:    ct[cidxs],
+            c.S_PID:  numpy.asarray(hits[c.S_PID])[h0][cidxs]}
+    return (tarr, bins, cols)
+
+def generate_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz,
+                   engine=c.ENGINE_VEC, aggregate=False, cached=None):
     """
     Generates an event in a standard gruid .json format, as is described in the attached README.md.
-    :param hits:  list of hits in the output format of the extract_hits() method.
+    :param hits:  hits of the event, as returned by the extract_hits() method. These are only read,
+                  so the same hits can be given to many calls with different parameters.
     :param nrows: number of rows in the array of scintillating fibers.
     :param ncols: number of columns in the array of scintillating fibers.
     :param dt:    delta t for the time series in ns.
@@ -193,14 +686,115 @@ def generate_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx,
     :param pnx:   x direction for the vector of the detecting plane.
     :param pny:   y direction for the vector of the detecting plane.
     :param pnz:   z direction for the vector of the detecting plane.
+    :param engine: engine used to generate the time series and detecting plane. Can be ENGINE_VEC
+                  or ENGINE_REF, as defined in constants.
+    :param aggregate: whether to aggregate the hits of each cell of the body's time series by PID,
+                  as described in _aggregate_cell(). The event's metadata is marked as S_AGGREGATED
+                  if so.
+    :param cached: dictionary with sections of the event (S_GRUIDH1, S_GRUIDH2, S_GRUIDHB or
+                  S_DPLANE) already generated with the same parameters, which are used instead of
+                  generating them again.
     :return:      an array of 2-dimensional sparse matrix as per scipy sparce's csr_matrix
                   definition. To further reduce storage use, if not hits are found for a dt, a
                   NoneType object is stored instead of an empty matrix.
+    :raises ValueError: if hits fall outside of the matrices, which usually means nrows and/or
+                  ncols are set wrong, or if the detecting plane's normal vector is 0.
+    """
+    (event, sarr) = _prepare_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, aggregate)
+    if cached is None: cached = {}
+
+    # Generate large events in the pool set by split_events(), as the loops below would.
+    split = {}
+    todo  = [s for s in sarr if s[0] not in cached]
+    plane = None
+    if not math.isnan(pvx) and c.S_DPLANE not in cached: plane = (pvx, pvy, pvz, pnx, pny, pnz)
+    nhits = sum(hits.count(s[1]) for s in todo) + (hits.count(c.S_DPLANE) if plane else 0)
+    if engine == c.ENGINE_VEC and _splitworkers > 1 and nhits >= _splithits:
+        with stats.timer(c.ST_SPLIT):
+            split = _generate_split(hits, todo, c.DX(in_ncols), c.DY(in_nrows), dt, dx, dy, dz,
+                                    aggregate, plane)
+        stats.count(c.ST_NSPLIT)
+
+    # Obtain time series.
+    gen_ts = _gen_ts_ref if engine == c.ENGINE_REF else _gen_ts
+    for s in sarr:
+        if s[0] in cached:
+            event[s[0]] = cached[s[0]]
+            continue
+        if s[0] in split:
+            event[s[0]] = split[s[0]]
+        else:
+            with stats.timer(c.ST_GENERATE + s[0]):
+                event[s[0]] = gen_ts(hits[s[1]], c.DX(in_ncols), c.DY(in_nrows), c.DZ, dt, dx, dy,
+                                      dz if s[0]==c.S_GRUIDHB else float("nan"), aggregate)
+        if stats.enabled:
+            stats.count(c.ST_CELLS + s[0], sum(len(m) for m in event[s[0]].values()))
+
+    # Obtain detecting plane data if needed.
+    gen_pd = _gen_pd_ref if engine == c.ENGINE_REF else _gen_pd
+    if not math.isnan(pvx) and c.S_DPLANE in cached:
+        event[c.S_DPLANE] = cached[c.S_DPLANE]
+    elif not math.isnan(pvx):
+        if c.S_DPLANE in split:
+            event[c.S_DPLANE] = split[c.S_DPLANE]
+        else:
+            with stats.timer(c.ST_GENERATE + c.S_DPLANE):
+                event[c.S_DPLANE] = gen_pd(hits[c.S_DPLANE], dt, pvx, pvy, pvz, pnx, pny, pnz)
+        if stats.enabled:
+            stats.count(c.ST_CELLS + c.S_DPLANE,
+                        sum(len(trks[c.S_TID]) for trks in event[c.S_DPLANE].values()))
+    return event
+
+def generate_arrays(hits, in_nrows, in_ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz,
+                    aggregate=False, cached=None):
+    """
+    Generates the same event as generate_event(), but with each time series and the detecting plane
+    stored as sparse arrays in coordinate format instead of dictionaries, so that they can be used
+    directly without being converted. Parameters and errors are the same as generate_event()'s,
+    with cached sections also stored as arrays.
+    :return: a dictionary with the gruid metadata under S_GRUIDMETA, as in generate_event(), and
+             with the arrays of each time series (S_GRUIDH1, S_GRUIDH2 and S_GRUIDHB if dz isn't
+             NaN) as returned by _gen_ts_coo(), and of the detecting plane (S_DPLANE if pvx isn't
+             NaN) as returned by _gen_pd_coo().
+    """
+    (event, sarr) = _prepare_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, aggregate)
+    if cached is None: cached = {}
+    for s in sarr:
+        if s[0] in cached:
+            event[s[0]] = cached[s[0]]
+            continue
+        with stats.timer(c.ST_GENERATE + s[0]):
+            event[s[0]] = _gen_ts_coo(hits[s[1]], c.DX(in_ncols), c.DY(in_nrows), c.DZ,
+                                      dt, dx, dy, dz if s[0]==c.S_GRUIDHB else float("nan"),
+                                      aggregate)
+        if stats.enabled: stats.count(c.ST_CELLS + s[0], _count_cells(event[s[0]]))
+    if not math.isnan(pvx) and c.S_DPLANE in cached:
+        event[c.S_DPLANE] = cached[c.S_DPLANE]
+    elif not math.isnan(pvx):
+        with stats.timer(c.ST_GENERATE + c.S_DPLANE):
+            event[c.S_DPLANE] = _gen_pd_coo(hits[c.S_DPLANE], dt, pvx, pvy, pvz, pnx, pny, pnz)
+        if stats.enabled: stats.count(c.ST_CELLS + c.S_DPLANE, event[c.S_DPLANE][c.S_TID].size)
+    return event
+
+def _count_cells(arrays):
+    """
+    Count the non-empty cells of a time series returned by _gen_ts_coo(), whose entries are grouped
+    by time step and cell.
+    """
+    keys = [arrays[col] for col in (c.S_TSTEP, c.S_X, c.S_Y, c.S_Z) if col in arrays]
+    if keys[0].size == 0: return 0
+    return 1 + int(numpy.any([k[1:] != k[:-1] for k in keys], axis=0).sum())
+
+def _prepare_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, aggregate=False):
+    """
+    Generate an event's gruid metadata and list which time series should be generated for it.
+    :return: a 2-tuple with the event (0), containing only its metadata, and a list of 2-tuples with
+             the name of each time series and the category of hits it's generated from (1).
     """
     out_ncols  = math.ceil(2*c.DX(in_ncols)/dx)
     out_nrows  = math.ceil(2*c.DY(in_nrows)/dy)
     sarr       = [(c.S_GRUIDH1,c.S_PHOTONH1), (c.S_GRUIDH2,c.S_PHOTONH2)]
-    event = {c.S_GRUIDMETA: {c.S_PID:hits[c.S_MASSHITS][c.S_PID][0],
+    event = {c.S_GRUIDMETA: {c.S_PID:int(hits[c.S_MASSHITS][c.S_PID][0]),
              c.S_DT:dt, c.S_DX:dx, c.S_DY:dy, c.S_NROWS:out_nrows, c.S_NCOLS:out_ncols}}
 
     # Add detector depth data if needed.
@@ -208,16 +802,5 @@ def generate_event(hits, in_nrows, in_ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx,
         sarr.append((c.S_GRUIDHB,c.S_MASSHITS))
         event[c.S_GRUIDMETA][c.S_DZ]     = dz
         event[c.S_GRUIDMETA][c.S_NDCOLS] = math.ceil(2*c.DZ/dz)
-
-    # Obtain time series.
-    for s in sarr:
-        event[s[0]] = _gen_ts(hits[s[1]], c.DX(in_ncols), c.DY(in_nrows), c.DZ,
-                              dt, dx, dy, dz if s[0]==c.S_GRUIDHB else float("nan"))
-
-    # Obtain detecting plane data if needed.
-    if not math.isnan(pvx):
-        chits = {}
-        for key in hits[c.S_MASSHITS]:
-            chits[key] = hits[c.S_MASSHITS][key] + hits[c.S_PHOTONHITS][key]
-        event[c.S_DPLANE] = _gen_pd(chits, dt, pvx, pvy, pvz, pnx, pny, pnz)
-    return event
+        if aggregate: event[c.S_GRUIDMETA][c.S_AGGREGATED] = True
+    return (event, sarr)
@@ -15,11 +15,22 @@ the scintillating fibers. It can also export these matrices as .json files for e
 """
 
 import argparse
+import collections
+import functools
+import itertools
+import math
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import constants as c
 import file_io as io
 import gemcevent_handler as gemc_eh
+import gemcfile_handler as fh
 import gruidevent_handler as gruid_eh
+import stats
 
 def setup_parser():
     parser = argparse.ArgumentParser()
@@ -39,28 +50,589 @@ def setup_parser():
     parser.add_argument("-o", "--outtype", help=c.OHELP, type=int)
     parser.add_argument("-r", "--nrows",   help=c.RHELP, type=int)
     parser.add_argument("-c", "--ncols",   help=c.CHELP, type=int)
+    parser.add_argument("-e", "--engine",  help=c.EHELP, choices=[c.ENGINE_VEC, c.ENGINE_REF],
+                        default=c.ENGINE_VEC)
+    parser.add_argument("-s", "--stream",  help=c.SHELP, action="store_true")
+    parser.add_argument("-w", "--workers", help=c.WHELP, type=int)
+    parser.add_argument("-i", "--index",   help=c.IDXHELP, action="store_true")
+    parser.add_argument("-t", "--typed",   help=c.TYHELP, action="store_true")
+    parser.add_argument("-m", "--mmap",    help=c.MMHELP, action="store_true")
+    parser.add_argument("-p", "--pipeline", help=c.PHELP, action="store_true")
+    parser.add_argument("--stats",         help=c.STATHELP, nargs='?', const='')
+    parser.add_argument("--profile",       help=c.PROFHELP)
+    parser.add_argument("--cache",         help=c.CACHEHELP, nargs='?', const=io.get_cache_path())
+    parser.add_argument("--cachesize",     help=c.CSIZEHELP, type=int)
+    parser.add_argument("--sweep",         help=c.SWHELP, action="append")
+    parser.add_argument("--compress",      help=c.CMPHELP, choices=list(c.COMPRESSIONS))
+    parser.add_argument("--indexed",       help=c.OIDXHELP, action="store_true")
+    parser.add_argument("--prefilter",     help=c.PREFHELP, action="store_true")
+    parser.add_argument("--pids",          help=c.PIDSHELP)
+    parser.add_argument("--volumes",       help=c.VOLSHELP)
+    parser.add_argument("--minhits",       help=c.MINHHELP, type=int)
+    parser.add_argument("--minedep",       help=c.MINEHELP, type=float)
+    parser.add_argument("--checkpoint",    help=c.CKPTHELP, type=int, nargs='?', const=c.CKPTEVENTS)
+    parser.add_argument("--aggregate",     help=c.AGGHELP,  action="store_true")
+    parser.add_argument("--max-memory",    help=c.MMEMHELP, type=int, dest="maxmemory")
+    parser.add_argument("--split-events",  help=c.SPLITHELP, type=int, nargs='?',
+                        const=c.SPLITHITS, dest="splithits")
+    parser.add_argument("--shardevents",   help=c.SEVHELP, type=int)
+    parser.add_argument("--shardsize",     help=c.SSIZEHELP, type=int)
     args = parser.parse_args()
     return args
 
-def run(ifile, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent, nevents, outtype, nrows, ncols):
+def translate_event(event, gargs, columnar=False):
+    """
+    Extract an event's hits and generate its gruid event.
+    :param event:    one event in the format defined by the store_event() method, or None if it was
+                     rejected by an event filter.
+    :param gargs:    tuple with the arguments given to generate_event() after the hits.
+    :param columnar: whether to generate the gruid event as arrays, as described in _generate().
+    :return:         a 2-tuple with the event's gemc hits (0) and gruid event (1). If the event has
+                     no massive particle hits or no photon hits, or was filtered, the gruid event is
+                     None.
+    """
+    with stats.timer(c.ST_EXTRACT):
+        hits = gemc_eh.extract_hits(event)
+    if not _check_hits(hits): return (hits, None)
+    return (hits, _generate(hits, gargs, columnar))
+
+def translate_sweep(event, gargslist, columnar=False):
+    """
+    Extract an event's hits once and generate its gruid event for each set of arguments in
+    gargslist, all of them reading the same hits.
+    :param event:     one event in the format defined by the store_event() method.
+    :param gargslist: list of tuples with the arguments given to generate_event() after the hits.
+    :param columnar:  whether to generate the gruid events as arrays, as described in _generate().
+    :return:          a 2-tuple with the event's gemc hits (0) and a list with its gruid event for
+                      each set of arguments (1). If the event has no massive particle hits or no
+                      photon hits, the list is None.
+    """
+    with stats.timer(c.ST_EXTRACT):
+        hits = gemc_eh.extract_hits(event)
+    if not _check_hits(hits): return (hits, None)
+    return (hits, [_generate(hits, gargs, columnar) for gargs in gargslist])
+
+def _generate(hits, gargs, columnar=False, cached=None):
+    """
+    Generate an event's gruid event with generate_event(), or with generate_arrays() if columnar,
+    as the .npz outputs store it. generate_arrays() has a single engine, so the one in gargs is
+    only used by generate_event().
+    """
+    if not columnar: return gruid_eh.generate_event(hits, *gargs, cached)
+    (nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, _, aggregate) = gargs
+    return gruid_eh.generate_arrays(hits, nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny,
+                                    pnz, aggregate, cached)
+
+def _check_hits(hits):
+    """Count an event's hits, and check that it has both massive particle and photon hits.
+    """
+    if hits is None: return False # Filtered events are counted as they're read.
+    for key in hits: stats.count(c.ST_HITS + key, hits.count(key))
+    if not hits.translatable():
+        stats.count(c.ST_SKIPPED)
+        return False
+    return True
+
+def translate_cached(addr, fid, ei, start, end, gargs, typed, cachedir, mapped=False,
+                     columnar=False):
+    """
+    Translate one event of an indexed gemc file, loading its hits and each section of its gruid
+    event from the translation cache when possible, and storing the ones that weren't there. The
+    event is only read if its hits aren't cached.
+    :param addr:     address of the gemc file.
+    :param fid:      identity of the gemc file, as returned by file_id().
+    :param ei:       event number.
+    :param start:    byte offset where the event starts, as stored in the file's index.
+    :param end:      byte offset where the event ends, as stored in the file's index.
+    :param gargs:    tuple with the arguments given to generate_event() after the hits.
+    :param typed:    whether to parse the event into typed arrays, as defined by store_event().
+    :param cachedir: path to the cache directory.
+    :param mapped:   whether to read the event from a memory-mapped file, with parse_event().
+    :param columnar: whether to generate the gruid event as arrays, as described in _generate().
+                     Sections are cached separately in each format.
+    :return:         a 2-tuple in the format returned by translate_event().
+    """
+    hits = io.load_cached(cachedir, (fid, ei))
+    if hits is None:
+        events = io.stream_range(addr, start, end, typed, mapped)
+        event  = next(events)
+        events.close()
+        with stats.timer(c.ST_EXTRACT):
+            hits = gemc_eh.extract_hits(event)
+        io.store_cached(cachedir, (fid, ei), hits)
+    if not _check_hits(hits): return (hits, None)
+
+    keys   = {section: (fid, ei) + key + ((c.S_COLUMNAR,) if columnar else ())
+              for (section, key) in _section_keys(gargs).items()}
+    cached = {}
+    for (section, key) in keys.items():
+        value = io.load_cached(cachedir, key)
+        if value is not None: cached[section] = value
+    gruidhits = _generate(hits, gargs, columnar, cached)
+    for (section, key) in keys.items():
+        if section not in cached: io.store_cached(cachedir, key, gruidhits[section])
+    return (hits, gruidhits)
+
+def _section_keys(gargs):
+    """Get the parameters that each section of a gruid event depends on, to be used as cache keys.
+    """
+    (nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, _, aggregate) = gargs
+    keys = {c.S_GRUIDH1: (c.S_GRUIDH1, nrows, ncols, dt, dx, dy),
+            c.S_GRUIDH2: (c.S_GRUIDH2, nrows, ncols, dt, dx, dy)}
+    if not math.isnan(dz):
+        keys[c.S_GRUIDHB] = (c.S_GRUIDHB, nrows, ncols, dt, dx, dy, dz, aggregate)
+    if not math.isnan(pvx): keys[c.S_DPLANE]  = (c.S_DPLANE, dt, pvx, pvy, pvz, pnx, pny, pnz)
+    return keys
+
+def translate_range(addr, start, end, gargs, typed=False, func=translate_event, mapped=False,
+                    efilter=None):
+    """
+    Read and translate the events stored between two byte offsets of a gemc file.
+    :return: a list of 2-tuples in the format returned by func, called as translate_event() is.
+    """
+    return [func(event, gargs)
+            for event in io.stream_range(addr, start, end, typed, mapped, efilter)]
+
+def translate_events(events, filename, fevent, gargs, workers=1, func=translate_event):
+    """
+    Translate events one by one, skipping the ones without massive particle or photon hits.
+    :param events:   iterable of events in the format defined by the store_event() method.
+    :param filename: name of the gemc file, used to generate each event's key.
+    :param fevent:   event number of the first event in events.
+    :param gargs:    tuple with the arguments given to generate_event() after the hits.
+    :param workers:  number of processes used to translate events. If larger than 1, events are
+                     translated in parallel but still yielded in order.
+    :param func:     function used to translate each event, called as translate_event() is.
+    :return:         a generator of 3-tuples with each event's key (0), gemc hits (1) and gruid
+                     event (2), as returned by func.
+    """
+    if workers > 1:
+        results = _pool_map(func, ((event, gargs) for event in events), workers)
+    else:
+        results = (func(event, gargs) for event in events)
+    return _key_results(results, filename, fevent)
+
+def translate_ranges(addr, ranges, filename, fevent, gargs, workers, typed=False,
+                     func=translate_event, mapped=False, efilter=None):
+    """
+    Translate the events in a list of byte ranges of a gemc file, with each worker reading the
+    events in its range by itself. Parameters and output are the same as translate_events()'s,
+    with ranges defined as returned by split_index(), and typed, mapped and efilter as defined by
+    stream_range().
+    """
+    results = _pool_map(translate_range, ((addr, r[1], r[2], gargs, typed, func, mapped, efilter)
+                                          for r in ranges), workers)
+    return _key_results(itertools.chain.from_iterable(results), filename, fevent)
+
+def _key_results(results, filename, fevent):
+    """Add each event's key to the translation results, skipping empty events.
+    """
+    for (ei, (gemchits, gruidhits)) in enumerate(results, fevent):
+        key = filename + ' ' + c.S_EVENT + ' ' + str(ei)
+        if gruidhits is None: continue
+        yield (key, gemchits, gruidhits)
+
+def _key_event(key):
+    """Get the event number of a key generated by _key_results().
+    """
+    return int(key.rsplit(' ', 1)[1])
+
+class Checkpoint:
+    """
+    Keeps track of how far a run got, storing a checkpoint every few events written with the last
+    event written, the position where the gemc file continues after it, and the state of each
+    output, so that an interrupted run can resume from there instead of starting over.
+    """
+    def __init__(self, addr, arguments, every):
+        """
+        Load the run's checkpoint, if there's one stored by a run with the same arguments.
+        :param addr:      address of the checkpoint.
+        :param arguments: string identifying the gemc file and every argument that changes the
+                          outputs.
+        :param every:     number of events written between checkpoints.
+        """
+        self.addr      = addr
+        self.arguments = arguments
+        self.every     = every
+        self.positions = collections.deque() # Filled by the reader, as described in stream_file().
+        self.first     = None                # Event read right before the first of the positions.
+        self.pending   = 0
+        self.state     = io.load_checkpoint(addr)
+        if self.state is not None and self.state[c.S_CKARGS] != arguments: self.state = None
+
+    def start(self, fevent, nevents):
+        """
+        Get where reading should start, after the last event written by an interrupted run.
+        :param fevent:  first event of the run.
+        :param nevents: number of events of the run, or 0 for all events from fevent onward.
+        :return:        a 3-tuple with the first event to read (0), the number of events to read
+                        (1), being None if there are none left, and the position of the gemc file
+                        where the first event starts (2), or None to read from the first event.
+        """
+        if self.state is None:
+            self.first = fevent
+            return (fevent, nevents, None)
+        self.first = self.state[c.S_CKEVENT] + 1
+        left = nevents - (self.first - fevent) if nevents else 0
+        return (self.first, left if left > 0 or not nevents else None, self.state[c.S_CKOFFSET])
+
+    def outputs(self, n):
+        """Get the states to resume each of the n outputs from, with None to start them over.
+        """
+        return [None]*n if self.state is None else self.state[c.S_CKOUTPUTS]
+
+    def written(self, key, outs):
+        """Keep track of an event written to outs, storing a checkpoint if it's time to.
+        """
+        self.pending += 1
+        if self.pending < self.every: return
+        self.pending = 0
+        ei = _key_event(key)
+        while self.first <= ei:
+            offset = self.positions.popleft()
+            self.first += 1
+        self.state = {c.S_CKARGS: self.arguments, c.S_CKEVENT: ei, c.S_CKOFFSET: offset,
+                      c.S_CKOUTPUTS: [out.checkpoint() for out in outs]}
+        io.store_checkpoint(self.addr, self.state)
+
+    def finish(self):
+        """Remove the checkpoint once the run is finished.
+        """
+        io.remove_checkpoint(self.addr)
+
+def _pool_map(func, argslist, workers):
+    """
+    Call func with each tuple of arguments in argslist in a pool of processes, yielding results in
+    the same order as argslist. At most 2*workers calls are in flight at once, so that reading never
+    gets too far ahead of translating. If stats are enabled, each worker's stats are merged into
+    this process'.
+    """
+    def result(future):
+        (res, snap) = future.result()
+        if snap is not None: stats.merge(snap)
+        return res
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for args in argslist:
+            pending.append(pool.submit(_pool_call, func, args, stats.enabled))
+            if len(pending) >= 2*workers: yield result(pending.popleft())
+        while pending: yield result(pending.popleft())
+
+def _prefetch(iterable, size=c.QUEUESIZE):
+    """
+    Iterate through iterable in a separate thread, yielding its items in order as they're ready. At
+    most size items wait to be yielded, so that the thread never gets too far ahead. Exceptions
+    raised while iterating, including exits, are raised again once reached.
+    """
+    items = queue.Queue(size)
+    stop  = threading.Event()
+    done  = object()
+
+    def put(item, exc=None):
+        """Wait until there's room for an item, returning False if nothing is consumed anymore.
+        """
+        while not stop.is_set():
+            try:
+                items.put((item, exc), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item): break
+            else:
+                put(done)
+        except BaseException as exc:
+            put(done, exc)
+        finally:
+            if hasattr(iterable, "close"): iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (item, exc) = items.get()
+            if exc is not None: raise exc
+            if item is done: return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def _pool_call(func, args, statson):
+    """Call func inside a worker, returning its result and, if statson, the stats of the call.
+    """
+    if not statson: return (func(*args), None)
+    stats.reset()
+    stats.enable()
+    res = func(*args)
+    return (res, stats.snapshot())
+
+def parse_sweep(specs, dt, dx, dy, dz):
+    """
+    Parse the binning configurations given with --sweep.
+    :param specs: list of grids, each a semicolon-separated list of "param=v1,v2,..." with param
+                  being dt, dx, dy or dz. Parameters missing from a grid take the value given as
+                  argument.
+    :return:      list of 4-tuples with every combination of dt (0), dx (1), dy (2) and dz (3) in
+                  each grid, in order and without repetitions.
+    """
+    confs = []
+    for spec in specs:
+        grid = {c.S_DT: [dt], c.S_DX: [dx], c.S_DY: [dy], c.S_DZ: [dz]}
+        for item in spec.split(';'):
+            (param, _, values) = item.partition('=')
+            param = param.strip()
+            try:
+                if param not in grid: raise ValueError
+                grid[param] = [float(v) for v in values.split(',')]
+            except ValueError:
+                print("ERROR: Invalid SWEEP \"" + item + "\". Each item should look like "
+                      "\"dt=0.5,1\", with dt, dx, dy or dz. Exiting...", file=sys.stderr)
+                exit()
+        confs += itertools.product(*grid.values())
+    return list(dict.fromkeys(confs))
+
+def parse_ints(arg, name):
+    """Parse a comma-separated list of integers given as the argument called name, or None.
+    """
+    if arg is None: return None
+    try:
+        return [int(v) for v in arg.split(',')]
+    except ValueError:
+        print("ERROR: " + name + " should be a comma-separated list of integers. Exiting...",
+              file=sys.stderr)
+        exit()
+
+def translation_error(e):
+    """Print an error raised while translating, such as hits outside of the matrices, and exit.
+    """
+    print("ERROR: " + str(e) + " Exiting...", file=sys.stderr)
+    exit()
+
+def sweep_suffix(conf):
+    """Generate the suffix added to the output filename of a binning configuration.
+    """
+    suffix = "_" + c.S_DT + str(conf[0]) + "_" + c.S_DX + str(conf[1]) + "_" + c.S_DY + str(conf[2])
+    if not math.isnan(conf[3]): suffix += "_" + c.S_DZ + str(conf[3])
+    return suffix
+
+def run(ifile, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent, nevents, outtype, nrows, ncols,
+        engine=c.ENGINE_VEC, aggregate=False, stream=False, workers=1, index=False, typed=False,
+        cache=None, cachesize=c.CACHESIZE, sweep=None, mapped=False, compress=None, indexed=False,
+        pipeline=False, shard=None, efilter=None, checkpoint=None, maxmemory=None):
     (path, filename) = io.split_address(ifile)
+    filename = io.strip_compression(filename)
     if nrows is None and ncols is None: (nrows, ncols) = io.decode_filename(filename)
-    (metadata, events) = io.load_file(ifile, fevent, nevents)
+    columnar = c.NPZTYPE <= outtype < c.NDJTYPE
+    (gargs, func) = translation_args(nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz,
+                                     engine, aggregate, sweep, columnar)
+    ckpt = None
+    if checkpoint is not None:
+        arguments = repr((io.file_id(ifile), fevent, nevents, outtype, gargs, compress, indexed,
+                          shard, efilter))
+        ckpt = Checkpoint(io.checkpoint_path(filename, fevent, nevents), arguments, checkpoint)
 
-    ei  = fevent
-    ged = {}
-    grd = {}
-    for event in events:
-        key = filename + ' ' + c.S_EVENT + ' ' + str(ei)
-        ei += 1
-        ged[key] = gemc_eh.extract_hits(event)
-        if len(ged[key][c.S_MASSHITS][c.S_N]) == 0 or \
-                (len(ged[key][c.S_PHOTONH1][c.S_N])==0 and len(ged[key][c.S_PHOTONH2][c.S_N])==0):
-            del ged[key]
-            continue
-        grd[key] = gruid_eh.generate_event(ged[key], nrows, ncols, dt, dx, dy, dz,
-                                           pvx, pvy, pvz, pnx, pny, pnz)
-    io.generate_output(grd, ged, metadata, filename, fevent, nevents, outtype)
+    idx = io.load_index(ifile) if index or cache is not None else None
+    if cache is not None:
+        # Translate each event by itself, reading only the ones whose hits aren't cached.
+        metadata = io.load_metadata(ifile)
+        fid      = io.file_id(ifile)
+        argslist = ((ifile, fid, r[0], r[1], r[2], gargs, typed, cache, mapped, columnar)
+                    for r in io.split_index(idx, fevent, nevents, 1))
+        if workers > 1: results = _pool_map(translate_cached, argslist, workers)
+        else:           results = (translate_cached(*args) for args in argslist)
+        results = _key_results(results, filename, fevent)
+    elif idx is not None and workers > 1 and io.compression(ifile) is None and ckpt is None:
+        # Let each worker read its own events. Compressed files are read by a single process
+        # instead, since each worker would have to decompress everything before its events.
+        metadata = io.load_metadata(ifile)
+        ranges   = io.split_index(idx, fevent, nevents, c.RANGESIZE)
+        results  = translate_ranges(ifile, ranges, filename, fevent, gargs, workers, typed, func,
+                                    mapped, efilter)
+    elif stream or pipeline or ckpt is not None or maxmemory is not None:
+        (sfevent, snevents, offset) = (fevent, nevents, None)
+        if ckpt is not None: (sfevent, snevents, offset) = ckpt.start(fevent, nevents)
+        if snevents is None:
+            # Every event was written before the run was interrupted, only closing the outputs.
+            (metadata, events) = (io.load_metadata(ifile), [])
+        else:
+            (metadata, events) = io.stream_file(ifile, sfevent, snevents, idx, typed, mapped,
+                                                efilter, offset,
+                                                None if ckpt is None else ckpt.positions)
+        if pipeline: events = _prefetch(events)
+        results = translate_events(events, filename, sfevent, gargs, workers, func)
+    else:
+        (metadata, events) = io.load_file(ifile, fevent, nevents, idx, typed, mapped, efilter)
+        results = translate_events(events, filename, fevent, gargs, workers, func)
+
+    write_results(results, metadata, filename, fevent, nevents, outtype, stream, sweep,
+                  compress=compress, indexed=indexed, pipeline=pipeline, shard=shard,
+                  checkpoint=ckpt, maxmemory=maxmemory)
+    if cache is not None: io.evict_cache(cache, cachesize*10**6)
+
+def translation_args(nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, engine, aggregate,
+                     sweep, columnar=False):
+    """
+    Get the arguments and function used to translate each event.
+    :param columnar: whether to generate gruid events as arrays, as described in _generate().
+    :return:         a 2-tuple with the arguments given to generate_event() after the hits (0) and
+                     the function that translates each event with them (1). For sweeps, the
+                     arguments are a list with one tuple per binning configuration.
+    """
+    if sweep is None:
+        gargs = (nrows, ncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, engine, aggregate)
+        func  = translate_event
+    else:
+        # Translate each event once for every binning configuration.
+        gargs = [(nrows, ncols, sdt, sdx, sdy, sdz, pvx, pvy, pvz, pnx, pny, pnz, engine, aggregate)
+                 for (sdt, sdx, sdy, sdz) in sweep]
+        func  = translate_sweep
+    if columnar: func = functools.partial(func, columnar=True)
+    return (gargs, func)
+
+def write_results(results, metadata, filename, fevent, nevents, outtype, stream=False, sweep=None,
+                  suffix="", compress=None, indexed=False, pipeline=False, shard=None,
+                  checkpoint=None, maxmemory=None):
+    """
+    Write translated events to the output defined by outtype, or to one output per binning
+    configuration for sweeps.
+    :param results:  iterable of 3-tuples as returned by translate_events(). For sweeps, the gruid
+                     event is a list with one gruid event per configuration.
+    :param metadata: metadata of the gemc file, as returned by store_metadata().
+    :param filename: name of the gemc file.
+    :param fevent:   first event read from the gemc file.
+    :param nevents:  number of events read from the gemc file.
+    :param outtype:  type of output to be generated, as defined in the README.
+    :param stream:   whether to write each event as soon as it's translated.
+    :param sweep:    list of binning configurations, as returned by parse_sweep(), or None.
+    :param suffix:   string added to the output filenames, before each configuration's suffix.
+    :param compress: compression format of the json outputs, as one of the COMPRESSIONS, or None.
+    :param indexed:  whether to store an index next to each json output.
+    :param pipeline: whether to translate events in a separate thread while they're written,
+                     which implies stream.
+    :param shard:    limits of each shard of the NDJSON outputs, as defined by ShardStream.
+    :param checkpoint: Checkpoint keeping track of the events written, which implies stream, or
+                       None.
+    :param maxmemory:  maximum size in MB of the events kept in memory by the .json outputs, which
+                       are written with a SpillStream sharing it, or None. Implies stream.
+    :return:         a 2-tuple with the number of events written (0) and the list of outputs (1).
+    """
+    # Write one output per binning configuration, each with its own suffix.
+    if sweep is None:
+        suffixes = [suffix]
+        results  = ((key, gemchits, [gruidhits]) for (key, gemchits, gruidhits) in results)
+    else:
+        suffixes = [suffix + sweep_suffix(conf) for conf in sweep]
+    outputs = [io.output_path(filename, fevent, nevents, outtype, sfx, compress)
+               for sfx in suffixes]
+
+    nwritten = 0
+    if pipeline: results = _prefetch(results)
+    if stream or pipeline or checkpoint is not None or maxmemory is not None:
+        # Write each event as soon as it's translated, keeping only one in memory, or as many as fit
+        # in the budget for SpillStreams.
+        states = [None]*len(suffixes) if checkpoint is None else checkpoint.outputs(len(suffixes))
+        budget = None if maxmemory is None else maxmemory*10**6 // len(suffixes)
+        with stats.timer(c.ST_WRITE):
+            outs = [io.open_stream(metadata, filename, fevent, nevents, outtype, sfx, compress,
+                                   indexed, shard, state, budget)
+                    for (sfx, state) in zip(suffixes, states)]
+        try:
+            for (key, gemchits, gruidlist) in results:
+                with stats.timer(c.ST_WRITE):
+                    for (out, gruidhits) in zip(outs, gruidlist):
+                        out.write(key, gruidhits, gemchits)
+                    if checkpoint is not None: checkpoint.written(key, outs)
+                nwritten += 1
+        finally:
+            with stats.timer(c.ST_WRITE):
+                for out in outs: out.close()
+        if checkpoint is not None: checkpoint.finish()
+    else:
+        ged  = {}
+        grds = [{} for _ in suffixes]
+        for (key, gemchits, gruidlist) in results:
+            ged[key] = gemchits
+            for (grd, gruidhits) in zip(grds, gruidlist): grd[key] = gruidhits
+        nwritten = len(ged)
+        with stats.timer(c.ST_WRITE):
+            for (grd, sfx) in zip(grds, suffixes):
+                io.generate_output(grd, ged, metadata, filename, fevent, nevents, outtype, sfx,
+                                   compress, indexed, shard)
+    return (nwritten, [out for out in outputs if out is not None])
+
+def run_batch(ifiles, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent, nevents, outtype, nrows,
+              ncols, engine=c.ENGINE_VEC, aggregate=False, stream=False, workers=1, typed=False,
+              sweep=None, mapped=False, compress=None, indexed=False, pipeline=False, shard=None,
+              efilter=None, maxmemory=None, index=False):
+    """
+    Translate many gemc files, sharing a single pool of WORKERS between all of them. Every file is
+    indexed and split in ranges of events, which are translated in order from the largest file to
+    the smallest, so that small files fill the pool while the last large one finishes. Compressed
+    files are read as a single range, since they can't be seeked without decompressing them from
+    the start, so they're translated first no matter their size, as they're the longest ranges.
+    Each file is written as soon as all of its ranges are translated. Arguments are the same as
+    run()'s, except for ifiles, the list of gemc files, and nrows and ncols, which if None are
+    decoded from each file's name. Indexes are only stored next to the files if index is True.
+    :return: the manifest of the batch, as a dictionary.
+    """
+    start = time.perf_counter()
+    ifiles = sorted(ifiles, key=lambda f: (io.compression(f) is None, -io.file_size(f)))
+
+    # Prepare each file's arguments and ranges.
+    jobs = []
+    for ifile in ifiles:
+        (path, filename) = io.split_address(ifile)
+        filename = io.strip_compression(filename)
+        (fnrows, fncols) = (nrows, ncols)
+        if nrows is None and ncols is None: (fnrows, fncols) = io.decode_filename(filename)
+        (gargs, func) = translation_args(fnrows, fncols, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny,
+                                         pnz, engine, aggregate, sweep,
+                                         c.NPZTYPE <= outtype < c.NDJTYPE)
+        idx    = io.load_index(ifile) if index else io.build_index(ifile)
+        size   = c.RANGESIZE if io.compression(ifile) is None else len(idx[c.S_IDXEVENTS])
+        ranges = io.split_index(idx, fevent, nevents, size)
+        jobs.append((ifile, filename, fnrows, fncols, gargs, func, ranges))
+
+    # Files whose outputs would have the same name keep the last part of their name, and the
+    # extension of their compression format, to tell them apart.
+    outfnames = [io.generate_outfilename(job[1], fevent, nevents) for job in jobs]
+    repeated  = collections.Counter(outfnames)
+    suffixes  = ["_" + '.'.join(job[1].split('.')[0:-1]).split('_')[-1]
+                 + io.split_address(job[0])[1][len(job[1]):].replace('.', '_')
+                 if repeated[outfname] > 1 else "" for (job, outfname) in zip(jobs, outfnames)]
+
+    argslist = ((ifile, r[1], r[2], gargs, typed, func, mapped, efilter)
+                for (ifile, _, _, _, gargs, func, ranges) in jobs for r in ranges)
+    if workers > 1: results = _pool_map(translate_range, argslist, workers)
+    else:           results = (translate_range(*args) for args in argslist)
+
+    def file_results(nranges, nread):
+        """Yield the results of a file's ranges, counting the events read into nread[0].
+        """
+        for chunk in itertools.islice(results, nranges):
+            nread[0] += len(chunk)
+            yield from chunk
+
+    manifest = {c.S_MFILES: []}
+    for ((ifile, filename, fnrows, fncols, _, _, ranges), suffix) in zip(jobs, suffixes):
+        t0       = time.perf_counter()
+        nread    = [0]
+        metadata = io.load_metadata(ifile)
+        fresults = _key_results(file_results(len(ranges), nread), filename, fevent)
+        (nwritten, outputs) = write_results(fresults, metadata, filename, fevent, nevents, outtype,
+                                            stream, sweep, suffix, compress, indexed,
+                                            pipeline, shard, maxmemory=maxmemory)
+        manifest[c.S_MFILES].append({c.S_MINPUT: ifile, c.S_MNROWS: fnrows, c.S_MNCOLS: fncols,
+                                     c.S_MOUTPUTS: outputs, c.S_MREAD: nread[0],
+                                     c.S_MWRITTEN: nwritten, c.S_MTIME: time.perf_counter() - t0})
+    manifest[c.S_MTIME] = time.perf_counter() - start
+    return manifest
 
 def main():
     args = setup_parser()
@@ -102,15 +674,128 @@ def main():
     outtype = 2
     if args.outtype:
         outtype = args.outtype
-        if outtype < 1 or outtype > 5:
-            print("ERROR: OUTTYPE should be between 1 and 5. Exiting...", file=sys.stderr)
+        if outtype < 1 or outtype > c.MAXTYPE:
+            print("ERROR: OUTTYPE should be between 1 and " + str(c.MAXTYPE) + ". Exiting...",
+                  file=sys.stderr)
+            exit()
+    workers = 1
+    if args.workers:
+        workers = args.workers
+        if workers < 1:
+            print("ERROR: WORKERS should be at least 1. Exiting...", file=sys.stderr)
+            exit()
+    cachesize = c.CACHESIZE
+    if args.cachesize is not None:
+        cachesize = args.cachesize
+        if cachesize < 0:
+            print("ERROR: CACHESIZE can't be negative. Exiting...", file=sys.stderr)
+            exit()
+    if args.checkpoint is not None:
+        if args.checkpoint < 1:
+            print("ERROR: CHECKPOINT should be at least 1. Exiting...", file=sys.stderr)
+            exit()
+        if outtype == 1 or c.NPZTYPE <= outtype < c.NDJTYPE:
+            print("ERROR: CHECKPOINT can't be used with OUTTYPE 1 or .npz outputs. Exiting...",
+                  file=sys.stderr)
+            exit()
+        if args.cache is not None:
+            print("ERROR: CHECKPOINT can't be used with CACHE. Exiting...", file=sys.stderr)
             exit()
+    if args.maxmemory is not None:
+        if args.maxmemory < 1:
+            print("ERROR: MAXMEMORY should be at least 1. Exiting...", file=sys.stderr)
+            exit()
+        if args.checkpoint is not None:
+            print("ERROR: MAXMEMORY can't be used with CHECKPOINT. Exiting...", file=sys.stderr)
+            exit()
+        if c.NPZTYPE <= outtype < c.NDJTYPE:
+            print("ERROR: MAXMEMORY can't be used with .npz outputs. Exiting...", file=sys.stderr)
+            exit()
+    if args.profile and args.pipeline and sys.version_info >= (3, 12):
+        # Since Python 3.12, only one cProfile profiler can run at a time, even in other threads.
+        print("ERROR: PROFILE can't be used with --pipeline on Python 3.12+. Exiting...",
+              file=sys.stderr)
+        exit()
+    if args.splithits is not None:
+        if args.splithits < 1:
+            print("ERROR: SPLITHITS should be at least 1. Exiting...", file=sys.stderr)
+            exit()
+        if workers < 2:
+            print("ERROR: SPLITHITS requires at least 2 WORKERS. Exiting...", file=sys.stderr)
+            exit()
+        # WORKERS split events instead of translating several of them at once.
+        gruid_eh.split_events(workers, args.splithits)
+        workers = 1
+    shardevents = c.SHARDEVENTS
+    if args.shardevents is not None:
+        shardevents = args.shardevents
+        if shardevents < 0:
+            print("ERROR: SHARDEVENTS can't be negative. Exiting...", file=sys.stderr)
+            exit()
+    shardsize = c.SHARDSIZE
+    if args.shardsize is not None:
+        shardsize = args.shardsize
+        if shardsize < 0:
+            print("ERROR: SHARDSIZE can't be negative. Exiting...", file=sys.stderr)
+            exit()
+    shard = (shardevents, shardsize*10**6)
+    efilter = None
+    if args.prefilter or args.pids or args.volumes or args.minhits or args.minedep:
+        if args.cache is not None:
+            print("ERROR: Event filters can't be used with CACHE. Exiting...", file=sys.stderr)
+            exit()
+        efilter = fh.EventFilter(parse_ints(args.pids, "PIDS"), parse_ints(args.volumes, "VOLUMES"),
+                                 args.minhits or 0, args.minedep or 0.)
+    sweep = None
+    if args.sweep:
+        if args.cache is not None:
+            print("ERROR: SWEEP can't be used with CACHE. Exiting...", file=sys.stderr)
+            exit()
+        sweep = parse_sweep(args.sweep, dt, dx, dy, dz)
     nrows = None
     if args.nrows: nrows = args.nrows
     ncols = None
     if args.ncols: ncols = args.ncols
 
-    run(ifile, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent, nevents, outtype, nrows, ncols)
+    if args.stats is not None: stats.enable()
+    if args.profile: stats.profile(args.profile.split(','))
+
+    (batch, ifiles) = io.find_inputs(ifile)
+    if batch:
+        if not ifiles:
+            print("ERROR: No gemc files found in " + ifile + ". Exiting...", file=sys.stderr)
+            exit()
+        if args.cache is not None:
+            print("ERROR: CACHE can't be used with a batch of files. Exiting...", file=sys.stderr)
+            exit()
+        if args.checkpoint is not None:
+            print("ERROR: CHECKPOINT can't be used with a batch of files. Exiting...",
+                  file=sys.stderr)
+            exit()
+        try:
+            manifest = run_batch(ifiles, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent,
+                                 nevents, outtype, nrows, ncols, args.engine, args.aggregate,
+                                 args.stream, workers, args.typed, sweep, args.mmap, args.compress,
+                                 args.indexed, args.pipeline, shard, efilter, args.maxmemory,
+                                 args.index)
+        except ValueError as e:
+            translation_error(e)
+        io.store_dict(manifest, io.get_path()+c.MANIFEST)
+    else:
+        if args.cache is not None and io.compression(ifile) is not None:
+            print("ERROR: CACHE can't be used with compressed files. Exiting...", file=sys.stderr)
+            exit()
+        try:
+            run(ifile, dt, dx, dy, dz, pvx, pvy, pvz, pnx, pny, pnz, fevent, nevents, outtype,
+                nrows, ncols, args.engine, args.aggregate, args.stream, workers, args.index,
+                args.typed, args.cache, cachesize, sweep, args.mmap, args.compress, args.indexed,
+                args.pipeline, shard, efilter, args.checkpoint, args.maxmemory)
+        except ValueError as e:
+            translation_error(e)
+
+    if args.stats:               io.store_stats(stats.summary(), args.stats)
+    elif args.stats is not None: stats.report()
+    stats.report_profile()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+
+# Gruid Translator by Bruno Benkel
+# To the extent possible under law, the person who associated CC0 with Gruid Translator has waived
+# all copyright and related or neighboring rights to Gruid Translator.
+
+"""
+Translation service, which keeps the translator loaded between requests instead of starting a new
+process for each of them. Requests are served over HTTP on a port on localhost or on a Unix socket,
+and name a gemc file, a range of events and the same binning parameters as main.py:
+
+    python src/server.py 8080 &
+    curl "localhost:8080/translate?filename=bcal_20_30_x.txt&dt=1&dx=0.3&dy=0.3&fevent=5&nevents=1"
+
+Each reply has the same format as the .json output for the requested OUTTYPE. The index and
+metadata of each gemc file and the most recently translated events are kept in memory, so that
+requesting an event again or with other output types doesn't translate it again.
+"""
+
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import math
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import urllib.parse
+
+import constants as c
+import file_io as io
+import main
+
+# Parameters of each request, with the function used to convert them from strings and their default
+# values. Parameters without a default are required.
+_PARAMS = {"filename": (str, None), "dt": (float, None), "dx": (float, None),
+           "dy": (float, None), "dz": (float, float("nan")), "pvx": (float, float("nan")),
+           "pvy": (float, float("nan")), "pvz": (float, float("nan")),
+           "pnx": (float, float("nan")), "pny": (float, float("nan")),
+           "pnz": (float, float("nan")), "fevent": (int, 1), "nevents": (int, 0),
+           "outtype": (int, 2), "nrows": (int, None), "ncols": (int, None),
+           "engine": (str, c.ENGINE_VEC), "aggregate": (str, "false")}
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("address",         help=c.ADDRHELP)
+    parser.add_argument("--request",       help=c.REQHELP)
+    parser.add_argument("-k", "--keep",    help=c.KEEPHELP, type=int)
+    parser.add_argument("-t", "--typed",   help=c.TYHELP, action="store_true")
+    parser.add_argument("-m", "--mmap",    help=c.MMHELP, action="store_true")
+    parser.add_argument("--cache",         help=c.CACHEHELP, nargs='?', const=io.get_cache_path())
+    parser.add_argument("--cachesize",     help=c.CSIZEHELP, type=int)
+    return parser.parse_args()
+
+class Service:
+    """
+    Translates events of gemc files on request, keeping the index and metadata of each file and the
+    most recently translated events in memory between requests. Requests can be served from several
+    threads at once.
+    """
+    def __init__(self, keep=c.SERVEEVENTS, typed=False, mapped=False, cache=None,
+                 cachesize=c.CACHESIZE):
+        """
+        :param keep:      maximum number of translated events kept in memory.
+        :param typed:     whether to parse events into typed arrays, as defined by store_event().
+        :param mapped:    whether to read events from memory-mapped files, with parse_event().
+        :param cache:     path to the translation cache directory, or None if it isn't used. Only
+                          used for uncompressed files.
+        :param cachesize: maximum size of the translation cache in MB.
+        """
+        self.keep      = keep
+        self.typed     = typed
+        self.mapped    = mapped
+        self.cache     = cache
+        self.cachesize = cachesize
+        self._files    = {}
+        self._events   = collections.OrderedDict()
+        self._lock     = threading.Lock()
+
+    def translate(self, query):
+        """
+        Translate the events requested by a query.
+        :param query: dictionary with the parameters of the request as strings, named as the
+                      arguments of main.py with their long names.
+        :return:      a dictionary in the format of the .json output for the requested OUTTYPE,
+                      with an entry for each translated event.
+        """
+        (addr, fevent, nevents, outtype, gargs) = parse_query(query)
+        filename = io.strip_compression(io.split_address(addr)[1])
+        if gargs[0] is None and gargs[1] is None:
+            try:
+                gargs = tuple(io.decode_filename(filename)) + gargs[2:]
+            except IndexError:
+                raise ValueError("nrows and ncols can't be read from " + filename) from None
+        (fid, index, metadata) = self._file(addr)
+
+        reply = {}
+        if outtype == 5: reply[c.S_GEMCMETA] = metadata
+        for (ei, start, end) in io.split_index(index, fevent, nevents, 1):
+            (hits, gruidhits) = self._event(addr, fid, ei, start, end, gargs)
+            if gruidhits is None: continue
+            key = filename + ' ' + c.S_EVENT + ' ' + str(ei)
+            reply[key] = io.merge_event(gruidhits, hits, outtype)
+        if self.cache is not None: io.evict_cache(self.cache, self.cachesize*10**6)
+        return reply
+
+    def _file(self, addr):
+        """
+        Get the identity, index and metadata of a gemc file, loading them again only if the file
+        changed since they were last loaded.
+        """
+        fid = io.file_id(addr)
+        with self._lock:
+            loaded = self._files.get(fid[0])
+        if loaded is None or loaded[0] != fid:
+            loaded = (fid, io.load_index(addr), io.load_metadata(addr))
+            with self._lock:
+                self._files[fid[0]] = loaded
+        return loaded
+
+    def _event(self, addr, fid, ei, start, end, gargs):
+        """
+        Translate one event of a gemc file, or get it from memory if it was translated with the same
+        arguments before. Parameters are the same as translate_cached()'s.
+        :return: a 2-tuple in the format returned by translate_event().
+        """
+        key = (fid, ei, gargs)
+        with self._lock:
+            if key in self._events:
+                self._events.move_to_end(key)
+                return self._events[key]
+
+        try:
+            if self.cache is not None and io.compression(addr) is None:
+                result = main.translate_cached(addr, fid, ei, start, end, gargs, self.typed,
+                                               self.cache, self.mapped)
+            else:
+                events = io.stream_range(addr, start, end, self.typed, self.mapped)
+                result = main.translate_event(next(events, None), gargs)
+                events.close()
+        except ValueError as e:
+            # generate_event() raises it when hits fall outside of the matrices.
+            raise ValueError("Event " + str(ei) + ": " + str(e)) from None
+
+        with self._lock:
+            self._events[key] = result
+            while len(self._events) > self.keep: self._events.popitem(last=False)
+        return result
+
+def parse_query(query):
+    """
+    Check the parameters of a translation request and convert them to the arguments used to
+    translate its events.
+    :param query: dictionary with the parameters of the request as strings.
+    :return:      a 5-tuple with the address of the gemc file (0), the first event (1) and number
+                  of events (2) to translate, the OUTTYPE of the reply (3) and the arguments given
+                  to generate_event() after the hits (4), with nrows and ncols set to None if they
+                  should be read from the filename.
+    """
+    unknown = set(query) - set(_PARAMS)
+    if unknown: raise ValueError("Unknown parameters: " + ", ".join(sorted(unknown)))
+    args = {}
+    for (name, (conv, default)) in _PARAMS.items():
+        if name not in query:
+            if default is None and name not in ("nrows", "ncols"):
+                raise ValueError("Missing parameter: " + name)
+            args[name] = default
+            continue
+        try:
+            args[name] = conv(query[name])
+        except ValueError:
+            raise ValueError("Invalid value for " + name + ": " + query[name]) from None
+
+    plane = [args[p] for p in ("pvx", "pvy", "pvz", "pnx", "pny", "pnz")]
+    if any(math.isnan(p) for p in plane) and not all(math.isnan(p) for p in plane):
+        raise ValueError("If one detecting plane variable is specified all should be")
+    if not math.isnan(plane[0]) and plane[3]**2 + plane[4]**2 + plane[5]**2 == 0:
+        raise ValueError("The detecting plane's normal vector is 0")
+    for name in ("dt", "dx", "dy", "dz"):
+        if not args[name] > 0 and not (name == "dz" and math.isnan(args[name])):
+            raise ValueError(name + " should be larger than 0")
+    if args["fevent"] < 1:     raise ValueError("fevent should be at least 1")
+    if args["nevents"] < 0:    raise ValueError("nevents can't be negative")
+    if not 1 <= args["outtype"] <= 5:
+        raise ValueError("outtype should be between 1 and 5")
+    if (args["nrows"] is None) != (args["ncols"] is None):
+        raise ValueError("nrows and ncols should be given together")
+    if args["nrows"] is not None and (args["nrows"] < 1 or args["ncols"] < 1):
+        raise ValueError("nrows and ncols should be at least 1")
+    if args["engine"] not in (c.ENGINE_VEC, c.ENGINE_REF):
+        raise ValueError("engine should be either " + c.ENGINE_VEC + " or " + c.ENGINE_REF)
+    if args["aggregate"] not in ("true", "false"):
+        raise ValueError("aggregate should be either true or false")
+    if not os.path.isfile(args["filename"]):
+        raise FileNotFoundError("No gemc file found in " + args["filename"])
+
+    gargs = (args["nrows"], args["ncols"], args["dt"], args["dx"], args["dy"], args["dz"], *plane,
+             args["engine"], args["aggregate"] == "true")
+    return (args["filename"], args["fevent"], args["nevents"], args["outtype"], gargs)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers translation requests sent to SERVEPATH with the service of its server, replying with
+    an error and its message instead if the request can't be translated.
+    """
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != c.SERVEPATH:
+            self._reply(404, {c.S_ERROR: "Unknown path: " + url.path})
+            return
+        try:
+            query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+            self._reply(200, self.server.service.translate(query))
+        except OSError as e:
+            self._reply(404, {c.S_ERROR: str(e)})
+        except ValueError as e:
+            self._reply(400, {c.S_ERROR: str(e)})
+
+    def address_string(self):
+        # Clients of Unix sockets have no address.
+        return str(self.client_address[0]) if self.client_address else self.server.server_address
+
+    def _reply(self, status, value):
+        body = json.dumps(value, indent=4, sort_keys=True).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket, serving each request in its own thread.
+    """
+    daemon_threads = True
+
+class _UnixConnection(http.client.HTTPConnection):
+    """HTTP connection to a server listening on a Unix socket.
+    """
+    def __init__(self, addr):
+        super().__init__(c.SERVEHOST)
+        self.addr = addr
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.addr)
+
+def serve(address, service):
+    """
+    Serve translation requests with a service until the process is interrupted or terminated.
+    :param address: port on localhost to serve requests on, or path of a Unix socket, which is
+                    removed once the service stops.
+    :param service: Service used to translate the requests.
+    """
+    if address.isdigit():
+        server = http.server.ThreadingHTTPServer((c.SERVEHOST, int(address)), _Handler)
+    else:
+        if os.path.exists(address): os.remove(address) # Left behind by a service that was killed.
+        server = _UnixServer(address, _Handler)
+    server.service = service
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not address.isdigit(): os.remove(address)
+
+def request(address, query):
+    """
+    Send a translation request to a running service.
+    :param address: port on localhost or path of a Unix socket on which the service is running.
+    :param query:   dictionary with the parameters of the request, as taken by translate().
+    :return:        a 2-tuple with the HTTP status of the reply (0) and its content (1), which is
+                    the dictionary returned by translate() if the status is 200, or a dictionary
+                    with an S_ERROR message otherwise.
+    """
+    if address.isdigit(): conn = http.client.HTTPConnection(c.SERVEHOST, int(address))
+    else:                 conn = _UnixConnection(address)
+    try:
+        conn.request("GET", c.SERVEPATH + "?" + urllib.parse.urlencode(query))
+        response = conn.getresponse()
+        return (response.status, json.loads(response.read()))
+    finally:
+        conn.close()
+
+def run():
+    args = setup_parser()
+
+    if args.request is not None:
+        query = dict(urllib.parse.parse_qsl(args.request, keep_blank_values=True))
+        try:
+            (status, reply) = request(args.address, query)
+        except OSError as e:
+            print("ERROR: No service running on " + args.address + " (" + str(e) + "). Exiting...",
+                  file=sys.stderr)
+            exit()
+        if status != 200:
+            print("ERROR: " + reply[c.S_ERROR] + ". Exiting...", file=sys.stderr)
+            exit()
+        print(json.dumps(reply, indent=4, sort_keys=True))
+        return
+
+    keep = c.SERVEEVENTS
+    if args.keep is not None:
+        keep = args.keep
+        if keep < 0:
+            print("ERROR: KEEP can't be negative. Exiting...", file=sys.stderr)
+            exit()
+    cachesize = c.CACHESIZE
+    if args.cachesize is not None:
+        cachesize = args.cachesize
+        if cachesize < 0:
+            print("ERROR: CACHESIZE can't be negative. Exiting...", file=sys.stderr)
+            exit()
+    serve(args.address, Service(keep, args.typed, args.mmap, args.cache, cachesize))
+
+if __name__ == "__main__":
+    run()
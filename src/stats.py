@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Gruid Translator by Bruno Benkel
+# To the extent possible under law, the person who associated CC0 with Gruid Translator has waived
+# all copyright and related or neighboring rights to Gruid Translator.
+
+"""
+Keeps track of the time spent in each stage of the program and of counters such as the number of
+events and hits processed, and allows profiling single functions with cProfile. Everything is
+disabled by default, in which case timers and counters do nothing.
+"""
+
+import contextlib
+import cProfile
+import functools
+import importlib
+import pstats
+import sys
+import threading
+import time
+
+import constants as c
+
+enabled   = False
+_timers   = {}
+_counters = {}
+_start    = None
+_profiles = []
+_pstate   = threading.local() # Profiler and depth of profiled calls in each thread.
+_lock     = threading.Lock() # Timers and counters can be updated from several threads.
+
+def enable():
+    """Enable timers and counters, and start the wall clock.
+    """
+    global enabled, _start
+    enabled = True
+    _start  = time.perf_counter()
+
+def reset():
+    """Clear all timers and counters.
+    """
+    _timers.clear()
+    _counters.clear()
+
+@contextlib.contextmanager
+def timer(name):
+    """Add the time spent inside the with block to the timer called name.
+    """
+    if not enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        with _lock: _timers[name] = _timers.get(name, 0.) + dt
+
+def count(name, n=1):
+    """Add n to the counter called name.
+    """
+    if not enabled: return
+    with _lock: _counters[name] = _counters.get(name, 0) + n
+
+def snapshot():
+    """Get a copy of all timers and counters, to be merged into another process' stats.
+    """
+    with _lock: return {c.S_TIMERS: dict(_timers), c.S_COUNTERS: dict(_counters)}
+
+def merge(snap):
+    """Add the timers and counters in a snapshot to this process' stats.
+    """
+    with _lock:
+        for (name, t) in snap[c.S_TIMERS].items():   _timers[name]   = _timers.get(name, 0.) + t
+        for (name, n) in snap[c.S_COUNTERS].items(): _counters[name] = _counters.get(name, 0) + n
+
+def profile(names):
+    """
+    Profile a list of functions with cProfile, without profiling the rest of the program. Functions
+    are replaced in their modules, so only calls looking them up through their module are profiled.
+    :param names: list of function names, in a "module.function" format (e.g.
+                  "gruidevent_handler._gen_ts").
+    """
+    for name in names:
+        (modname, funcname) = name.rsplit('.', 1)
+        module = importlib.import_module(modname)
+        setattr(module, funcname, _profiled(getattr(module, funcname)))
+
+def _profiled(func):
+    """
+    Wrap func so that the calling thread's profiler runs during its calls. Each thread has its own
+    profiler, and they're combined by report_profile().
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not hasattr(_pstate, "profiler"):
+            (_pstate.profiler, _pstate.depth) = (cProfile.Profile(), 0)
+            with _lock: _profiles.append(_pstate.profiler)
+        depth = _pstate.depth
+        if depth == 0: _pstate.profiler.enable()
+        _pstate.depth = depth + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _pstate.depth = depth
+            if depth == 0: _pstate.profiler.disable()
+    return wrapper
+
+def summary():
+    """
+    Summarize all timers and counters.
+    :return: a dictionary with the wall time since stats were enabled, all timers and counters, and
+             the number of events and hits processed per second.
+    """
+    wall  = time.perf_counter() - _start if _start is not None else 0.
+    snap  = snapshot()
+    (timers, counters) = (snap[c.S_TIMERS], snap[c.S_COUNTERS])
+    nhits = sum(n for (name, n) in counters.items() if name.startswith(c.ST_HITS))
+    return {c.S_WALL: wall, c.S_TIMERS: timers, c.S_COUNTERS: counters,
+            c.S_EVENTSPS: counters.get(c.ST_EVENTS, 0)/wall if wall else 0.,
+            c.S_HITSPS: nhits/wall if wall else 0.}
+
+def report():
+    """Print a summary of all timers and counters to stderr.
+    """
+    s = summary()
+    print("{:<40} {:>12} {:>7}".format("stage", "time (s)", "share"), file=sys.stderr)
+    for (name, t) in sorted(s[c.S_TIMERS].items(), key=lambda x: -x[1]):
+        print("{:<40} {:12.4f} {:6.1f}%".format(name, t, 100*t/s[c.S_WALL] if s[c.S_WALL]
+                                                 else 0.), file=sys.stderr)
+    print("{:<40} {:>12}".format("counter", "value"), file=sys.stderr)
+    for (name, n) in sorted(s[c.S_COUNTERS].items()):
+        print("{:<40} {:12d}".format(name, n), file=sys.stderr)
+    print("wall time: {:.4f} s, {:.2f} events/s, {:.2f} hits/s".format(s[c.S_WALL],
+          s[c.S_EVENTSPS], s[c.S_HITSPS]), file=sys.stderr)
+
+def report_profile():
+    """Print the profile of the functions given to profile() to stderr, if any were called.
+    """
+    with _lock: profiles = list(_profiles)
+    if not profiles: return
+    ps = pstats.Stats(profiles[0], stream=sys.stderr)
+    for prof in profiles[1:]: ps.add(prof)
+    ps.sort_stats("cumulative").print_stats(30)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Gruid Translator by Bruno Benkel
+# To the extent possible under law, the person who associated CC0 with Gruid Translator has waived
+# all copyright and related or neighboring rights to Gruid Translator.
+
+"""
+In-process API of the translator, which translates gemc events into sparse arrays in memory instead
+of writing them to an output file. Nothing is written to the filesystem, except for the event index
+if it's requested. With src/ in the python path:
+
+    import translator
+    for (ei, hits, event) in translator.translate_file("bcal_20_30_x.txt", 1, 0.3, 0.3, dz=0.25):
+        side1 = event["gruid hits - side 1"] # Arrays "time step", "x", "y", "# of hits", ...
+
+Each event is translated as generate_arrays() describes, with the same columns and types as the
+.npz outputs.
+"""
+
+import file_io as io
+import gemcevent_handler as gemc_eh
+import gruidevent_handler as gruid_eh
+
+def translate_file(addr, dt, dx, dy, dz=float("nan"), plane=None, fevent=1, nevents=0, nrows=None,
+                   ncols=None, index=False, typed=True, mapped=False, efilter=None,
+                   aggregate=False):
+    """
+    Read and translate the events of a gemc file one at a time.
+    :param addr:    address of the gemc file, which can be compressed.
+    :param dt:      length of each time step in ns.
+    :param dx:      length of each row of the time series' matrices in cm.
+    :param dy:      length of each column of the time series' matrices in cm.
+    :param dz:      length of each depth column of the detector's body time series in cm. If this is
+                    NaN, the body isn't translated.
+    :param plane:   6-tuple with the position of the detecting plane's vertex (0-2) and the direction
+                    of its normal vector (3-5), or None if the detecting plane isn't used.
+    :param fevent:  first event to read.
+    :param nevents: number of events to read. Set to 0 to read all events from fevent onward.
+    :param nrows:   number of rows set in the gemc simulation. If both nrows and ncols are None,
+                    they're read from the filename.
+    :param ncols:   number of columns set in the gemc simulation.
+    :param index:   whether to use the file's event index to reach fevent, as described in the
+                    load_index() method.
+    :param typed:   whether to parse the banks into typed arrays, as described in store_event().
+    :param mapped:  whether to memory-map the file, as described in stream_file().
+    :param efilter: EventFilter that events must pass to be parsed and translated, or None.
+    :param aggregate: whether to aggregate the body's hits in each cell by PID, with one entry per
+                    PID in each cell instead of one per hit, as described in _gen_ts_coo().
+    :return:        a generator of 3-tuples in the format returned by translate_events().
+    :raises ValueError: if an event's hits fall outside of the matrices, as generate_event() does.
+    """
+    (_, filename) = io.split_address(addr)
+    if nrows is None and ncols is None:
+        (nrows, ncols) = io.decode_filename(io.strip_compression(filename))
+    idx = io.load_index(addr) if index else None
+    (_, events) = io.stream_file(addr, fevent, nevents, idx, typed, mapped, efilter)
+    yield from translate_events(events, nrows, ncols, dt, dx, dy, dz, plane, fevent, aggregate)
+
+def translate_events(events, nrows, ncols, dt, dx, dy, dz=float("nan"), plane=None, fevent=1,
+                     aggregate=False):
+    """
+    Translate events already read from a gemc file, skipping the ones without massive particle hits
+    or photon hits on the endplates. Parameters are the same as translate_file()'s.
+    :param events: iterable of events in the format defined by the store_event() method, with
+                   events rejected by an event filter given as None.
+    :param fevent: event number of the first event, used to number the rest.
+    :return:       a generator of 3-tuples with each event's number (0), its hits as returned by
+                   extract_hits() (1), and its gruid event as returned by generate_arrays() (2).
+    """
+    for (ei, event) in enumerate(events, fevent):
+        hits = gemc_eh.extract_hits(event)
+        if hits is None or not hits.translatable(): continue
+        yield (ei, hits, translate_hits(hits, nrows, ncols, dt, dx, dy, dz, plane, aggregate))
+
+def translate_hits(hits, nrows, ncols, dt, dx, dy, dz=float("nan"), plane=None, aggregate=False):
+    """
+    Translate the hits of a single event, which should have massive particle hits and photon hits on
+    the endplates. Parameters are the same as translate_file()'s.
+    :param hits: hits of the event, as returned by extract_hits().
+    :return:     the gruid event, as returned by generate_arrays().
+    """
+    if plane is None: plane = (float("nan"),)*6
+    return gruid_eh.generate_arrays(hits, nrows, ncols, dt, dx, dy, dz, *plane, aggregate)